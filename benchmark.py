@@ -0,0 +1,290 @@
+import argparse
+import datetime
+import importlib.util
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from werkzeug.serving import make_server
+
+# Synthetic data, polls go back from END so the latest week is always well covered
+END = datetime.datetime(2023, 1, 25, 18, 0, 0) # Roughly where the real dataset stops
+TSFMT = "%Y-%m-%d %H:%M:%S"
+POLL_MINUTES = 60 # Stores get polled about once an hour
+POLL_JITTER = 10 # Minutes, standard deviation of the poll interval
+P_DOWN = 0.05 # Chance an active store is found inactive on the next poll
+P_UP = 0.4 # Chance an inactive store is back on the next poll
+TIMEZONES = [
+    "America/Chicago", "America/New_York", "America/Denver", "America/Los_Angeles",
+    "America/Boise", "America/Phoenix", "America/Detroit", None, # None = no row, the apps fall back to America/Chicago
+]
+HERE = os.path.dirname(os.path.abspath(__file__))
+POLL = 0.05 # Seconds between /get_report polls for clients that have to poll
+
+def gendb(path, stores, events, seed): # Builds a store_monitoring.db with stores x events status rows, timezones and business hours
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE store_status (id INTEGER PRIMARY KEY AUTOINCREMENT, store_id TEXT, timestamp_utc TEXT, status TEXT);
+        CREATE TABLE timezones (store_id TEXT PRIMARY KEY, timezone_str TEXT NOT NULL);
+        CREATE TABLE business_hours (store_id TEXT, day_of_week INTEGER, start_time_local TEXT, end_time_local TEXT);
+        CREATE INDEX idx_business_hours_store ON business_hours (store_id);
+        CREATE TABLE reports (report_id TEXT PRIMARY KEY, store_id TEXT, repdata TEXT, generated_at TEXT);
+    """)
+    store_ids = [f"{rnd.getrandbits(64):016x}" for _ in range(stores)] # Opaque IDs like the real ones
+    for store_id in store_ids:
+        rows = []
+        t = END - datetime.timedelta(minutes=rnd.uniform(0, POLL_MINUTES))
+        status = 'active'
+        for _ in range(events): # Newest first, a small Markov chain for outages
+            rows.append((store_id, t.strftime(TSFMT), status))
+            status = ('inactive' if rnd.random() < P_DOWN else 'active') if status == 'active' else ('active' if rnd.random() < P_UP else 'inactive')
+            t -= datetime.timedelta(minutes=max(5, rnd.gauss(POLL_MINUTES, POLL_JITTER)))
+        rnd.shuffle(rows) # The CSVs aren't sorted either
+        conn.executemany("INSERT INTO store_status (store_id, timestamp_utc, status) VALUES (?,?,?)", rows)
+        tz = rnd.choice(TIMEZONES)
+        if tz:
+            conn.execute("INSERT INTO timezones (store_id, timezone_str) VALUES (?,?)", (store_id, tz))
+        if rnd.random() < 0.7: # The rest are open 24/7
+            opens = rnd.choice(["06:00", "08:00", "10:00"])
+            closes = rnd.choice(["18:00", "22:00", "23:30", "02:00"]) # 02:00 = open past midnight
+            for day in range(7):
+                if rnd.random() < 0.1:
+                    continue # Closed that day
+                conn.execute("INSERT INTO business_hours VALUES (?,?,?,?)", (store_id, day, opens, closes))
+    conn.commit()
+    conn.close()
+    return store_ids
+
+def loadapp(name, workdir): # Imports one of the apps against the database in workdir
+    os.chdir(workdir) # The old app opens store_monitoring.db relative to the working directory
+    os.environ['STORE_MONITORING_DB'] = os.path.join(workdir, 'store_monitoring.db')
+    os.environ['REPORT_DIR'] = os.path.join(workdir, 'reports')
+    spec = importlib.util.spec_from_file_location(name, os.path.join(HERE, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    logging.getLogger().setLevel(logging.WARNING) # Both apps log every report at INFO
+    logging.getLogger('werkzeug').setLevel(logging.WARNING) # And the dev server every request
+    return module
+
+def stats(samples): # Summary of a list of durations in seconds
+    samples = sorted(samples)
+    if not samples:
+        return {"n": 0}
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {
+        "n": len(samples),
+        "total_s": round(sum(samples), 6),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+        "p50_ms": round(pick(0.5) * 1000, 3),
+        "p95_ms": round(pick(0.95) * 1000, 3),
+        "p99_ms": round(pick(0.99) * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+def timed(fn, args_list): # Runs fn over every args tuple, returns the durations
+    out = []
+    for args in args_list:
+        started = time.perf_counter()
+        fn(*args)
+        out.append(time.perf_counter() - started)
+    return out
+
+def latest(workdir, store_ids): # MAX(timestamp_utc) of each store as a datetime, the reference time of its report (gendb writes TEXT)
+    conn = sqlite3.connect(os.path.join(workdir, 'store_monitoring.db'))
+    out = {}
+    for store_id in store_ids:
+        value = conn.execute("SELECT MAX(timestamp_utc) FROM store_status WHERE store_id=?", (store_id,)).fetchone()[0]
+        out[store_id] = datetime.datetime.strptime(value, TSFMT)
+    conn.close()
+    return out
+
+def benchfunctions(name, app, workdir, sample): # calctime, gencsv and buildrep of one app
+    result = {}
+    started = time.perf_counter()
+    if name == 'new_flask_app': # Schema, indexes and the hourly rollup are built on first use, keep that out of the timings
+        with app.dbconn():
+            pass
+        if app.ROLLUP:
+            app.refreshrollup()
+    result["setup_s"] = round(time.perf_counter() - started, 6)
+    refs = latest(workdir, sample)
+    for label, span in (("calctime_hour", datetime.timedelta(hours=1)), ("calctime_day", datetime.timedelta(days=1)), ("calctime_week", datetime.timedelta(weeks=1))):
+        result[label] = stats(timed(app.calctime, [(s, refs[s] - span, refs[s]) for s in sample]))
+    result["gencsv"] = stats(timed(app.gencsv, [(s,) for s in sample]))
+    durations = []
+    for store_id in sample: # Everything a worker does for one report, storage included
+        if name == 'new_flask_app':
+            app.enqueuejob(store_id, None) # No data version, never coalesced
+            repid, store_id = app.claimjob()[:2]
+        else:
+            repid = f"bench-{store_id}"
+            app.reports[repid] = {'store_id': store_id, 'state': 'Pending', 'repdata': None}
+        started = time.perf_counter()
+        app.buildrep(repid, store_id)
+        durations.append(time.perf_counter() - started)
+    result["buildrep"] = stats(durations)
+    return result
+
+def client(base, store_ids, wait, out, lock, name): # One client: trigger a report, then fetch it until it is a CSV
+    headers = {"X-Client-Id": name} # The new app limits reports in flight per client, every thread is its own client
+    for store_id in store_ids:
+        started = time.perf_counter()
+        requests = 1
+        try:
+            with urllib.request.urlopen(urllib.request.Request(f"{base}/trigger_report?store_id={urllib.parse.quote(store_id)}", headers=headers)) as r:
+                repid = json.load(r)['repid']
+            while True:
+                url = f"{base}/get_report?repid={repid}" + (f"&wait={wait}" if wait else "")
+                requests += 1
+                with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as r:
+                    body = r.read()
+                    if r.status == 200 and r.headers.get_content_type() == 'text/csv':
+                        break
+                if not wait:
+                    time.sleep(POLL)
+            ok = body.count(b'\n') >= 2 # Header and a row
+        except (urllib.error.URLError, OSError, ValueError):
+            ok = False
+        with lock:
+            out['latency'].append(time.perf_counter() - started)
+            out['requests'] += requests
+            out['errors'] += 0 if ok else 1
+
+def bulkclient(base, store_ids, seed, stop, out, lock): # Keeps one large batch report building until stop is set, each batch a different list so none coalesce
+    rnd = random.Random(seed)
+    headers = {"Content-Type": "application/json", "X-Client-Id": f"bulk-{seed}"}
+    while not stop.is_set():
+        body = json.dumps({"store_ids": rnd.sample(store_ids, max(1, len(store_ids) * 9 // 10))}).encode('utf-8')
+        try:
+            with urllib.request.urlopen(urllib.request.Request(f"{base}/trigger_report", data=body, headers=headers)) as r:
+                repid = json.load(r)['repid']
+            while not stop.is_set():
+                with urllib.request.urlopen(f"{base}/get_report?repid={repid}&wait=5") as r:
+                    r.read()
+                    if r.status == 200:
+                        break
+            with lock:
+                out['bulk'] += 1
+        except (urllib.error.URLError, OSError, ValueError):
+            stop.wait(POLL) # 429/503 included, back off and go again
+
+def benchendpoints(name, app, store_ids, clients, per_client, bulk=0): # /trigger_report + /get_report throughput under concurrent clients, plus bulk batch clients in the background
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    wait = 30 if name == 'new_flask_app' else 0 # The old app can only be polled
+    out = {'latency': [], 'requests': 0, 'errors': 0, 'bulk': 0}
+    lock = threading.Lock()
+    rnd = random.Random(len(store_ids))
+    plan = [[rnd.choice(store_ids) for _ in range(per_client)] for _ in range(clients)]
+    threads = [threading.Thread(target=client, args=(base, stores, wait, out, lock, f"client-{i}")) for i, stores in enumerate(plan)]
+    stop = threading.Event()
+    background = [threading.Thread(target=bulkclient, args=(base, store_ids, i, stop, out, lock), daemon=True) for i in range(bulk if name == 'new_flask_app' else 0)]
+    for t in background: # Only the new app takes batches
+        t.start()
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    for t in background:
+        t.join()
+    server.shutdown()
+    reports = clients * per_client
+    return {
+        "clients": clients,
+        "reports": reports,
+        "seconds": round(elapsed, 6),
+        "reports_per_s": round(reports / elapsed, 3) if elapsed else None,
+        "requests": out['requests'],
+        "requests_per_report": round(out['requests'] / reports, 3),
+        "errors": out['errors'],
+        "report_latency": stats(out['latency']),
+        "bulk_clients": len(background),
+        "bulk_reports": out['bulk'],
+    }
+
+def gitrev(): # Commit the numbers belong to, None outside a checkout
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the report pipeline of the old and new app on a synthetic database.")
+    parser.add_argument('--stores', type=int, default=200, help="Stores in the synthetic database")
+    parser.add_argument('--events', type=int, default=500, help="Status rows per store (about an hour apart)")
+    parser.add_argument('--seed', type=int, default=1, help="Seed of the generator, same seed = same database")
+    parser.add_argument('--sample', type=int, default=50, help="Stores the function timings run on")
+    parser.add_argument('--clients', type=int, default=8, help="Concurrent HTTP clients")
+    parser.add_argument('--requests', type=int, default=10, help="Reports each client triggers and downloads")
+    parser.add_argument('--bulk', type=int, default=0, help="Clients building large batch reports in the background of the endpoint run (new app only)")
+    parser.add_argument('--apps', default='old_flask_app,new_flask_app', help="Comma separated apps to benchmark")
+    parser.add_argument('--out', help="Write the JSON here instead of stdout")
+    parser.add_argument('--keep', action='store_true', help="Keep the working directory (databases, report files)")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='store-bench-')
+    cwd = os.getcwd()
+    try:
+        started = time.perf_counter()
+        pristine = os.path.join(root, 'store_monitoring.db')
+        store_ids = gendb(pristine, args.stores, args.events, args.seed)
+        generated = time.perf_counter() - started
+        sample = random.Random(args.seed).sample(store_ids, min(args.sample, len(store_ids)))
+        results = {}
+        for name in args.apps.split(','):
+            workdir = os.path.join(root, name) # Each app gets its own copy, the new app adds indexes and tables
+            os.makedirs(workdir)
+            shutil.copy(pristine, os.path.join(workdir, 'store_monitoring.db'))
+            app = loadapp(name, workdir)
+            results[name] = benchfunctions(name, app, workdir, sample)
+            results[name]["endpoints"] = benchendpoints(name, app, store_ids, args.clients, args.requests, args.bulk)
+            os.chdir(cwd)
+        report = {
+            "meta": {
+                "generated_at": datetime.datetime.utcnow().strftime(TSFMT),
+                "git": gitrev(),
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "seed": args.seed,
+                "stores": args.stores,
+                "events_per_store": args.events,
+                "rows": args.stores * args.events,
+                "generate_s": round(generated, 6),
+                "sample": len(sample),
+            },
+            "results": results,
+        }
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f"Working directory kept at {root}", file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
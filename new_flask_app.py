@@ -1,11 +1,31 @@
-from flask import Flask, request, jsonify, Response, make_response
+from flask import Flask, request, jsonify, Response, make_response, stream_with_context, send_file
 import threading
+import socket
+import os
+import contextlib
+import time
+import click
+import array
+import bisect
+import heapq
+import multiprocessing
+import concurrent.futures
+import zlib
+import gzip
 import uuid
+import random
+import json
+import hashlib
+import functools
+import cProfile
+import pstats
 import csv
 import io
 import sqlite3
 import datetime
 import logging
+import itertools
+import collections
 import pytz
 
 app = Flask(__name__)
@@ -16,117 +36,1023 @@ logging.basicConfig( # Basic logging structure for all the mishaps that may occu
     format='%(asctime)s %(levelname)s: %(message)s'
 )
 
-# In-memory store for reports.
-reports = {} # Dictionary for reports
+# Report states live in the report_jobs table, this lock guards what stays in memory: repcache and starting the workers
 reports_lock = threading.Lock() # Thread lock for handling unpredictiveness (Possibility of Edge Case?)
 
-def dbconnect(): # Connects to sql database
+TSFMT = "%Y-%m-%d %H:%M:%S" # How timestamp_utc is stored
+EPOCH = datetime.datetime(1970, 1, 1) # Naive UTC epoch, reftime and the chains are naive UTC too
+# Trailing windows in the report as (span, label, unit), add one here to get another column pair out of the same scan
+REPORT_WINDOWS = [
+    (datetime.timedelta(hours=1), "hour", "min"),
+    (datetime.timedelta(days=1), "day", "hrs"),
+    (datetime.timedelta(weeks=1), "week", "hrs"),
+]
+UNITS = {"min": 60.0, "hrs": 3600.0} # Seconds per unit of a report column
+WINDOWS = [span for span, _, _ in REPORT_WINDOWS]
+CSVHEADER = ( # Report columns, shared by the single store, batch and fleet reports: every uptime, then every downtime
+    ["store_id"]
+    + [f"uptime_last_{label}({unit})" for _, label, unit in REPORT_WINDOWS]
+    + [f"downtime_last_{label}({unit})" for _, label, unit in REPORT_WINDOWS]
+)
+ALLSTORES = '*' # store_id for the fleet report
+BATCH = '+' # store_id prefix of batch reports, followed by a digest of the store list; the list itself is in report_jobs.stores
+BATCH_MAX = int(os.environ.get('REPORT_BATCH_MAX', 1000)) # Stores one batch trigger may list
+IN_CHUNK = 500 # Store IDs per IN (...) query, well under SQLite's bound parameter limit
+CSV_CHUNK = 16 * 1024 # Characters/bytes per chunk when reports are generated and streamed
+REPORT_GZIP = os.environ.get('REPORT_GZIP', '1') == '1' # Send gzip to clients that take it, gzipped report files as they are, reports from the repdata column compressed on the fly
+
+# Report jobs live in the report_jobs table, any process (or host sharing the database) can trigger, claim and look them up
+WORKERS = int(os.environ.get('REPORT_WORKERS', 4)) # Worker threads building reports, per process
+QUEUE_DEPTH = int(os.environ.get('REPORT_QUEUE_DEPTH', 64)) # Pending jobs allowed across all processes, past that triggers get a 503
+RETRY_AFTER = 5 # Seconds, sent with the 503 and with reports that aren't done yet
+JOB_LEASE = int(os.environ.get('REPORT_JOB_LEASE', 300)) # Seconds a claimed job stays with its process without a heartbeat
+JOB_ATTEMPTS = int(os.environ.get('REPORT_JOB_ATTEMPTS', 3)) # Claims before a job whose workers keep dying is marked Error
+JOB_POLL = 1.0 # Seconds an idle worker waits before looking for jobs triggered by other processes
+HOST = socket.gethostname() # Host part of a job owner, see owner()
+jobready = threading.Semaphore(0) # Released per local trigger, wakes a worker without waiting out JOB_POLL
+workers = [] # Worker threads plus the lease heartbeat, started on the first request
+JOB_WAIT_MAX = 60 # Longest /get_report?wait= blocks, seconds
+SSE_MAX = 600 # Seconds a /report_events stream stays open
+SSE_KEEPALIVE = 15 # Seconds between keepalive comments on a quiet stream
+# Admission control, cheap reports (interactive lane) never queue behind fleet, batch and prewarm reports (bulk lane)
+LANES = ('interactive', 'bulk')
+BULK_EVENTS = int(os.environ.get('REPORT_BULK_EVENTS', 50000)) # Estimated cost (status rows behind the report) from which a report is bulk
+BULK_WORKERS = int(os.environ.get('REPORT_BULK_WORKERS', max(1, WORKERS // 2))) # Workers per process building bulk reports at once, the rest stay free for interactive ones
+CLIENT_JOBS = int(os.environ.get('REPORT_CLIENT_JOBS', 8)) # Pending/Running jobs one client may have created, past that it gets a 429
+CLIENT_BULK_JOBS = int(os.environ.get('REPORT_CLIENT_BULK_JOBS', 2)) # Of which bulk
+BUDGETS = { # Seconds a report may run before it is cancelled, 0 = no limit
+    'interactive': float(os.environ.get('REPORT_INTERACTIVE_BUDGET', 60)),
+    'bulk': float(os.environ.get('REPORT_BULK_BUDGET', 1800)),
+}
+bulkbusy = 0 # Bulk reports this process is building right now, guarded by metrics_lock
+claim_lock = threading.Lock() # Workers of this process claim one at a time, so a claim sees bulkbusy with every earlier bulk claim in it
+rejected = {'full': 0, 'client': 0} # Triggers turned away, queue full (503) or client over its limit (429), guarded by metrics_lock
+jobcond = threading.Condition() # notify_all on every job state change made by this process
+jobgen = 0 # Bumped with every notify, so a waiter can't miss one between its lookup and its wait
+
+# Finished reports by the data they were computed from, a trigger with nothing new to report gets the old report back
+REPORT_CACHE_ENTRIES = int(os.environ.get('REPORT_CACHE_ENTRIES', 4096)) # Entries are a key and a repid, LRU past this
+REPORT_CACHE_TTL = int(os.environ.get('REPORT_CACHE_TTL', 3600)) # Seconds a cached report is handed out
+REPORT_MAX_AGE = 86400 # Cache-Control max-age of /get_report, seconds
+
+# Finished reports are files, the reports table only keeps where they are
+REPORT_DIR = os.path.abspath(os.environ.get('REPORT_DIR', 'report_files')) # Not reports/, that's the example CSVs in git. Absolute, send_file would resolve a relative path against the app package
+REPORT_COMPRESS = os.environ.get('REPORT_COMPRESS', '1') == '1' # Write report.csv.gz instead of report.csv
+
+# Retention, finished reports and their jobs are purged after REPORT_RETENTION by a sweeper thread in every serving process
+REPORT_RETENTION = int(os.environ.get('REPORT_RETENTION', 7 * 86400)) # Seconds, 0 keeps everything
+SWEEP_EVERY = 300 # Seconds between sweeps
+SWEEP_BATCH = 500 # Rows deleted per transaction, writers never wait long on a sweep
+VACUUM_PAGES = 2000 # Free pages handed back to the filesystem per sweep
+repcache = collections.OrderedDict() # (store_id, data version) -> {'repid', 'expires'}, guarded by reports_lock
+
+# Pre-materialization, reports of the most triggered stores are rebuilt in the background before anyone asks
+PREWARM_STORES = int(os.environ.get('REPORT_PREWARM_STORES', 20)) # Hottest stores kept warm per process, 0 turns it off
+PREWARM_EVERY = int(os.environ.get('REPORT_PREWARM_EVERY', 60)) # Seconds between looks for new status rows of the hot stores
+PREWARM_MIN = float(os.environ.get('REPORT_PREWARM_MIN', 3)) # Decayed trigger count a store needs before it counts as hot
+HEAT_HALFLIFE = 3600 # Seconds for a store's trigger count to halve
+HEAT_ENTRIES = 10000 # Stores tracked, the coldest are forgotten past this
+heat = {} # store_id -> [decayed trigger count, time.monotonic() of the last update], guarded by heat_lock
+heat_lock = threading.Lock()
+prewarmed = 0 # Jobs the prewarmer queued, for /metrics
+
+# Database, one pre-configured connection per thread
+DBPATH = os.environ.get('STORE_MONITORING_DB', 'store_monitoring.db')
+DBTIMEOUT = 30 # Seconds to wait on a locked database before giving up
+CACHED_STATEMENTS = 256 # Prepared statements kept per connection, the report queries are a handful of fixed strings
+MMAP_SIZE = 256 * 1024 * 1024 # Bytes of the db file read through mmap
+CACHE_KB = 64 * 1024 # Page cache per connection
+pool = threading.local() # pool.conn = this thread's connection
+READONLY = False # Set in the report processes, their connections are opened read-only
+schema_ready = False # initdb runs once per process
+schema_lock = threading.Lock() # The background threads all open their connections at once, one of them prepares the schema
+EPOCHTS = None # True once store_status holds epoch seconds and 1/0 status codes (migrate-epoch), None = not looked yet
+MIGRATE_SAMPLE = 200 # Stores migrate-epoch times the window queries on
+
+# Hourly rollup of store_status, long windows sum it instead of replaying raw events
+ROLLUP = os.environ.get('REPORT_ROLLUP', '1') == '1'
+ROLLUP_MIN = 2 * 3600 # Seconds, shorter windows are mostly edge hours and go straight to store_status
+rollup_lock = threading.Lock()
+
+# Fleet reports sharded by store across processes, the sweeps are pure Python and the GIL keeps threads on one core
+PROCESSES = int(os.environ.get('REPORT_PROCESSES', 0)) # 0/1 = scan in the worker thread
+SHARDS_PER_PROCESS = 4 # More shards than processes so a slow shard doesn't hold up the report
+procpool = None # ProcessPoolExecutor, started on first use
+procpool_lock = threading.Lock()
+
+# In-memory event index, per store epoch seconds in an array('q') plus packed status bits
+EVENTINDEX = os.environ.get('REPORT_EVENT_INDEX', '0') == '1'
+EVENTINDEX_EVENTS = int(os.environ.get('REPORT_EVENT_INDEX_EVENTS', 5000000)) # Events held across all stores, least recently used stores go first
+EVENTINDEX_RECHECK = float(os.environ.get('REPORT_EVENT_INDEX_RECHECK', 5.0)) # Seconds an entry is trusted before looking for rows written by other processes
+eventindex = collections.OrderedDict() # store_id -> entry, guarded by eventindex_lock
+eventindex_size = 0 # Events held right now
+eventindex_lock = threading.Lock()
+
+# Store timezones, the whole table lives in memory and reloads when its triggers bump table_versions
+DEFAULT_TZ = "America/Chicago"
+TZ_RECHECK = 30.0 # Seconds between looks at table_versions
+tzcache = {'version': None, 'names': {}, 'tzinfos': {}, 'checked': float('-inf')} # names = store_id -> timezone_str, tzinfos = resolved pytz objects
+tzcache_lock = threading.Lock()
+
+# Only time inside a store's business_hours counts, stores without any are open 24/7
+BUSINESS_HOURS = os.environ.get('REPORT_BUSINESS_HOURS', '1') == '1'
+VERSIONED = ('timezones', 'business_hours') # Tables whose changes table_versions counts, reports depend on them besides store_status
+# Each store's parsed hours and its last compiled UTC schedule stay in memory until business_hours' table_versions row moves
+hourscache = {'version': None, 'rows': {}, 'compiled': {}, 'checked': float('-inf')} # rows = store_id -> {day_of_week: [(start, end)]} ({} = 24/7), compiled = store_id -> ((timezone, lo, hi), intervals)
+hourscache_lock = threading.Lock()
+
+# Bulk loads, table -> (CSV columns, insert statement, row conversion)
+INGEST_BATCH = 50000 # Rows per executemany
+INGEST_TABLES = {
+    'store_status': (
+        ('store_id', 'timestamp_utc', 'status'),
+        "INSERT INTO store_status (store_id, timestamp_utc, status) VALUES (?,?,?)",
+        lambda r: (r[0], *storeevent(normts(r[1]), r[2].strip())),
+    ),
+    'timezones': (
+        ('store_id', 'timezone_str'),
+        "INSERT OR REPLACE INTO timezones (store_id, timezone_str) VALUES (?,?)",
+        lambda r: (r[0], r[1].strip()),
+    ),
+    'business_hours': (
+        ('store_id', 'day_of_week', 'start_time_local', 'end_time_local'),
+        "INSERT INTO business_hours (store_id, day_of_week, start_time_local, end_time_local) VALUES (?,?,?,?)",
+        lambda r: (r[0], int(r[1]), r[2].strip(), r[3].strip()),
+    ),
+}
+
+# Stage timings for /metrics, fixed buckets so an observation is a bisect and two adds
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0) # Seconds
+STAGES = ('connect', 'timezone', 'business_hours', 'prior_query', 'range_query', 'sweep', 'csv_encode', 'store')
+histograms = {stage: {'buckets': [0] * (len(METRIC_BUCKETS) + 1), 'sum': 0.0, 'count': 0} for stage in STAGES} # Last bucket = +Inf
+finished = {'Complete': 0, 'Error': 0} # Reports this process built, by outcome
+busy = 0 # Reports this process is building right now
+metrics_lock = threading.Lock()
+PROFILE_LINES = 40 # Functions kept in a profiled job's summary
+
+def observe(stage, seconds): # Adds one timing to a stage histogram
+    h = histograms[stage]
+    i = bisect.bisect_left(METRIC_BUCKETS, seconds)
+    with metrics_lock:
+        h['buckets'][i] += 1
+        h['sum'] += seconds
+        h['count'] += 1
+
+def timed(stage): # Decorator, every call of the function is one observation of stage
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observe(stage, time.perf_counter() - started)
+        return inner
+    return wrap
+
+def owner(): # Who holds a claimed job, the pid is read at claim/heartbeat time so workers forked after import (gunicorn --preload) each get their own
+    return f"{HOST}:{os.getpid()}"
+
+def checkdeadline(deadline): # Cooperative cancellation, raises TimeoutError once a report is past its deadline (time.monotonic(), None = no limit)
+    if deadline is not None and time.monotonic() > deadline:
+        raise TimeoutError("Cancelled, ran past its budget.")
+
+def initdb(conn): # Tables and indexes the app relies on, safe to run again
+    global schema_ready
     try:
-        conn = sqlite3.connect('store_monitoring.db') # Try connecting to the db
+        # Base tables, same layout as the hand converted CSVs so an empty database can be loaded through ingest
+        conn.execute("CREATE TABLE IF NOT EXISTS store_status (id INTEGER PRIMARY KEY AUTOINCREMENT, store_id TEXT, timestamp_utc TEXT, status TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS timezones (store_id TEXT PRIMARY KEY, timezone_str TEXT NOT NULL)")
+        # Any number of intervals per store and day (split shifts), so no primary key, just the per store lookup
+        conn.execute("CREATE TABLE IF NOT EXISTS business_hours (store_id TEXT, day_of_week INTEGER, start_time_local TEXT, end_time_local TEXT)")
+        if any(row[5] for row in conn.execute("PRAGMA table_info(business_hours)")): # Older databases keyed it on (store_id, day_of_week), rebuilt without the key
+            conn.execute("DROP TABLE IF EXISTS business_hours_rekeyed")
+            conn.execute("CREATE TABLE business_hours_rekeyed (store_id TEXT, day_of_week INTEGER, start_time_local TEXT, end_time_local TEXT)")
+            conn.execute("INSERT INTO business_hours_rekeyed SELECT store_id, day_of_week, start_time_local, end_time_local FROM business_hours")
+            conn.execute("DROP TABLE business_hours") # Takes its version triggers along, recreated below
+            conn.execute("ALTER TABLE business_hours_rekeyed RENAME TO business_hours")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_business_hours_store ON business_hours (store_id)")
+        conn.execute("CREATE TABLE IF NOT EXISTS reports (report_id TEXT PRIMARY KEY, store_id TEXT, repdata TEXT, generated_at TEXT)")
+        # Report files, older databases only have repdata, those rows keep being served from the column
+        have = {row[1] for row in conn.execute("PRAGMA table_info(reports)")}
+        for column, decl in (('path', 'TEXT'), ('size', 'INTEGER'), ('encoding', 'TEXT')):
+            if column not in have:
+                conn.execute(f"ALTER TABLE reports ADD COLUMN {column} {decl}")
+        # (store_id, timestamp_utc) serves the per store range queries and the ordered fleet scan without a sort
+        if not EPOCHTS: # Migrated tables have the covering index instead
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_store_status_store_ts ON store_status (store_id, timestamp_utc)")
+        # Per store, per UTC hour seconds spent active/inactive and the status carried into the hour
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS store_status_hourly ("
+            "store_id TEXT, hour_utc INTEGER, active_sec INTEGER, inactive_sec INTEGER, carry_status TEXT, "
+            "PRIMARY KEY (store_id, hour_utc)) WITHOUT ROWID"
+        )
+        # Change counters kept by triggers, so caches of small tables know when to reload and reports know what they were built from
+        conn.execute("CREATE TABLE IF NOT EXISTS table_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)")
+        for table in VERSIONED:
+            conn.execute("INSERT OR IGNORE INTO table_versions (name, version) VALUES (?, 0)", (table,))
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                conn.execute(
+                    f"CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table} "
+                    f"BEGIN UPDATE table_versions SET version = version + 1 WHERE name='{table}'; END"
+                )
+        conn.execute("CREATE TABLE IF NOT EXISTS rollup_state (name TEXT PRIMARY KEY, last_rowid INTEGER, updated_at TEXT)")
+        # Report jobs, state is Pending/Running/Complete/Error, result is the report file once Complete
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS report_jobs ("
+            "report_id TEXT PRIMARY KEY, store_id TEXT NOT NULL, data_version TEXT, state TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, owner TEXT, lease_until REAL, "
+            "created_at TEXT, started_at TEXT, finished_at TEXT, result TEXT, error TEXT)"
+        )
+        have = {row[1] for row in conn.execute("PRAGMA table_info(report_jobs)")}
+        # stores = JSON list of a batch report's stores, profiled = run under cProfile, profile = its summary
+        # lane = interactive/bulk, cost = estimated status rows, client = who triggered it (per-client limits)
+        for column, decl in (
+            ('stores', 'TEXT'), ('profiled', 'INTEGER NOT NULL DEFAULT 0'), ('profile', 'TEXT'),
+            ('lane', "TEXT NOT NULL DEFAULT 'interactive'"), ('cost', 'INTEGER'), ('client', 'TEXT'),
+        ):
+            if column not in have:
+                conn.execute(f"ALTER TABLE report_jobs ADD COLUMN {column} {decl}")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_report_jobs_state ON report_jobs (state, created_at)") # Claims and the queue depth
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_report_jobs_data ON report_jobs (store_id, data_version)") # Coalescing triggers
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_report_jobs_client ON report_jobs (client, state)") # Per-client limits
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_report_jobs_finished ON report_jobs (finished_at)") # Retention sweeps
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_reports_generated ON reports (generated_at)")
+        conn.commit()
+    except sqlite3.Error as e:
+        logging.error("Couldn't prepare the database schema: %s", e)
+    schema_ready = True
+
+@timed('connect')
+def dbconnect(): # Connects to sql database, configured once per connection
+    try:
+        if READONLY:
+            conn = sqlite3.connect(f"file:{DBPATH}?mode=ro", uri=True, timeout=DBTIMEOUT, cached_statements=CACHED_STATEMENTS)
+        else:
+            conn = sqlite3.connect(DBPATH, timeout=DBTIMEOUT, cached_statements=CACHED_STATEMENTS) # Try connecting to the db
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL") # Takes on new databases, existing ones switch at their next VACUUM
+            conn.execute("PRAGMA journal_mode=WAL") # Readers and the writer stop blocking each other
+        conn.execute("PRAGMA synchronous=NORMAL") # Safe under WAL, fsync only at checkpoints
+        conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size=-{CACHE_KB}") # Negative = KiB instead of pages
+        if EPOCHTS is None:
+            detectformat(conn)
+        if not schema_ready:
+            with schema_lock:
+                if not schema_ready: # Another thread may have done it while we waited
+                    initdb(conn)
         return conn # Output as return if it succeeds
     except sqlite3.Error as e:
         msg = f"Couldn't connect to the database: {e}"
         logging.error(msg) # Log as error, function call to logging
         raise sqlite3.Error(msg)
-def getz(store_id):
+
+def detectformat(conn): # Looks at how store_status stores timestamps, the declared type tells a migrated table apart
+    global EPOCHTS
+    types = {row[1]: (row[2] or '').upper() for row in conn.execute("PRAGMA table_info(store_status)")}
+    EPOCHTS = types.get('timestamp_utc') == 'INTEGER'
+
+@contextlib.contextmanager
+def dbconn(): # Checks out this thread's pooled connection, opened on first use and kept for the life of the thread
+    conn = getattr(pool, 'conn', None)
+    if conn is None:
+        conn = pool.conn = dbconnect()
     try:
-        conn = dbconnect()
-        cur = conn.cursor()
-        cur.execute("SELECT timezone_str FROM timezones WHERE store_id=?", (store_id,))
-        row = cur.fetchone()
-        conn.close()
-        if row and row[0]:
-            return row[0]
+        yield conn
+    except sqlite3.ProgrammingError: # Closed or otherwise unusable, next checkout opens a fresh one
+        pool.conn = None
+        raise
+    except Exception:
+        if conn.in_transaction:
+            conn.rollback() # Don't leave a half done write on the pooled connection
+        raise
+    else:
+        if conn.in_transaction:
+            conn.commit()
+
+def loadtimezones(): # Makes sure tzcache holds the current timezones table, reloading it whole when it changed
+    now = time.monotonic()
+    if now - tzcache['checked'] < TZ_RECHECK: # Hot path, a plain dict lookup away
+        return
+    with tzcache_lock:
+        if now - tzcache['checked'] < TZ_RECHECK: # Someone else just did it
+            return
+        try:
+            with dbconn() as conn:
+                cur = conn.cursor()
+                cur.execute("SELECT version FROM table_versions WHERE name='timezones'") # Bumped by triggers on every change
+                row = cur.fetchone()
+                version = row[0] if row else None
+                if version is None or version != tzcache['version']:
+                    cur.execute("SELECT store_id, timezone_str FROM timezones")
+                    names = {store_id: tz_str for store_id, tz_str in cur if tz_str}
+                    tzcache['names'] = names
+                    tzcache['tzinfos'] = {} # Resolved again lazily against the new names
+                    tzcache['version'] = version
+                    logging.info("Loaded %d store timezones.", len(names))
+            tzcache['checked'] = now
+        except Exception as e:
+            logging.error("Error loading the timezones table: %s", e) # Keep serving what we have
+
+def resolve(store_id): # tzinfo of a store, America/Chicago when it has none (or an unknown one)
+    loadtimezones()
+    tzinfo = tzcache['tzinfos'].get(store_id)
+    if tzinfo is None:
+        tz_str = tzcache['names'].get(store_id, DEFAULT_TZ)
+        try:
+            tzinfo = pytz.timezone(tz_str)
+        except Exception as e:
+            logging.error("Unknown timezone '%s' for store '%s', using %s: %s", tz_str, store_id, DEFAULT_TZ, e)
+            tzinfo = pytz.timezone(DEFAULT_TZ)
+        tzcache['tzinfos'][store_id] = tzinfo
+    return tzinfo
+
+@timed('timezone')
+def resolve_many(store_ids): # {store_id: tzinfo} for a batch of stores, one freshness check for all of them
+    loadtimezones()
+    return {store_id: resolve(store_id) for store_id in store_ids}
+
+def toepoch(dt): # naive UTC datetime -> epoch seconds, all the window math runs on plain ints
+    return int((dt - EPOCH).total_seconds())
+
+def fmtts(ts): # epoch seconds -> the TEXT format stored in store_status
+    return (EPOCH + datetime.timedelta(seconds=ts)).strftime(TSFMT)
+
+@timed('sweep')
+def sweep(events, inic, ce, starts, hours=None): # One walk over the timeline, every segment gets split across all the windows
+    # events = [(epoch, status), ...] ascending, none before min(starts) or after ce
+    # inic = status in effect at min(starts), starts = window starts, all windows end at ce
+    # hours = sorted open (start, end) intervals, only time inside them counts, None = open 24/7
+    ups = [0] * len(starts)
+    downs = [0] * len(starts)
+    cur, state = min(starts), inic
+    j = 0 # First open interval that can still overlap, both lists only move forward
+    for ts, status in itertools.chain(events, ((ce, None),)): # End marker; state is not used.
+        if hours is None:
+            pieces = ((cur, ts),)
         else:
-            logging.info("No timezone found for store '%s'. Assuming America/Chicago.", store_id)
-            return "America/Chicago"
-    except Exception as e:
-        logging.error("Error fetching timezone for store '%s': %s", store_id, e)
-        return "America/Chicago"
+            while j < len(hours) and hours[j][1] <= cur:
+                j += 1
+            pieces = []
+            m = j
+            while m < len(hours) and hours[m][0] < ts:
+                pieces.append((max(cur, hours[m][0]), min(ts, hours[m][1])))
+                m += 1
+        for a, b in pieces:
+            for k, ws in enumerate(starts):
+                lo = max(a, ws) # Clip the segment to the window start
+                if b > lo:
+                    if state == 'active':
+                        ups[k] += b - lo # increment the uptime by duration
+                    else:
+                        downs[k] += b - lo # increment the down time if its inactive
+        cur, state = ts, status
+    return list(zip(ups, downs))
 
-def calctime(store_id, cs, ce): # Calculation of uptime or downtime 
-    # cs = chain start
-    # ce = chain end
-    try:
-        conn = dbconnect() # Call the function db connect
-        cur = conn.cursor() # New cursor object for sqlite3
-    except Exception as e:
-        logging.error("Failed to get DB connection in calculation of uptime and downtime ,calctime: %s", e) # log this issue by calling logging
-        return 0, 0
+def clip(hours, lo, hi): # Open intervals cut down to [lo, hi], None (24/7) becomes the whole range
+    if hours is None:
+        return [(lo, hi)]
+    return [(max(a, lo), min(b, hi)) for a, b in hours if b > lo and a < hi]
 
-    try: # To get the last event
-        cur.execute(
-            "SELECT timestamp_utc, status FROM store_status WHERE store_id=? AND timestamp_utc < ? ORDER BY timestamp_utc DESC LIMIT 1",
-            (store_id, cs.strftime("%Y-%m-%d %H:%M:%S")) # Format the sql o/p as our needs
-        )
-        row = cur.fetchone() # Iterates over the sqlite elements till no element with the id is present
-        if row:
-            inic = row[1] # Take the 2nd value, ie; its status (active/inactive)
+def wallspan(tz, a, b): # UTC epoch intervals of the instants whose local wall time is in [a, b) (naive local datetimes)
+    # Same as checking every minute against the hours: a repeated fall-back hour is open twice, a skipped spring-forward one not at all
+    edges = [toepoch(tz.localize(t, is_dst=dst).astimezone(pytz.utc).replace(tzinfo=None)) for t in (a, b) for dst in (True, False)]
+    wa, wb = toepoch(a), toepoch(b) # Wall clock on the epoch scale, utc = wall - offset
+    if edges[0] == edges[1] and edges[2] == edges[3] and wa - edges[0] == wb - edges[2]: # One offset all along, the usual case
+        return [(edges[0], edges[2])]
+    lo, hi = min(edges), max(edges)
+    offset = lambda t: int(pytz.utc.localize(EPOCH + datetime.timedelta(seconds=t)).astimezone(tz).utcoffset().total_seconds())
+    before, after = offset(lo), offset(hi)
+    t0, t1 = lo, hi # The offset changes once in between, find the second it does
+    while t1 - t0 > 1:
+        mid = (t0 + t1) // 2
+        if offset(mid) == before:
+            t0 = mid
         else:
-            inic = 'active' # Assume event is active 24/7 if there is no event
-    except sqlite3.Error as e:
-        logging.error("SQL error in calctime while fetching prior event for store '%s': %s", store_id, e) # log this error
-        conn.close() # Close connection
-        return 0, 0
+            t1 = mid
+    pieces = [(max(lo, wa - before), min(t1, wb - before)), (max(t1, wa - after), min(hi, wb - after))]
+    return [(x, y) for x, y in pieces if y > x]
+
+def parsehours(rows): # Weekly (day_of_week, start_time_local, end_time_local) rows -> {day_of_week: [(start, end) times]}
+    byday = {}
+    for dow, start, end in rows:
+        try:
+            byday.setdefault(int(dow), []).append((datetime.time.fromisoformat(start), datetime.time.fromisoformat(end)))
+        except Exception as e:
+            logging.error("Skipping bad business hours row (%s, %s, %s): %s", dow, start, end, e)
+    return byday
 
-    # Get events within the chain.
+def compileschedule(byday, tz, lo, hi): # parsehours output -> merged UTC intervals over [lo, hi]
+    # Every local day in range is localized on its own, so DST shifts inside the lookback land where they should (see wallspan)
+    day = (EPOCH + datetime.timedelta(seconds=lo)).date() - datetime.timedelta(days=2) # Slack for the UTC offset and overnight hours
+    last = (EPOCH + datetime.timedelta(seconds=hi)).date() + datetime.timedelta(days=1)
+    intervals = []
+    while day <= last:
+        for start, end in byday.get(day.weekday(), ()): # 0 = Monday, same as business_hours.day_of_week
+            a = datetime.datetime.combine(day, start)
+            b = datetime.datetime.combine(day, end)
+            if b <= a: # Past midnight (or the same time twice = the whole day)
+                b += datetime.timedelta(days=1)
+            for a, b in wallspan(tz, a, b):
+                if b > lo and a < hi:
+                    intervals.append((max(a, lo), min(b, hi)))
+        day += datetime.timedelta(days=1)
+    intervals.sort()
+    merged = []
+    for a, b in intervals: # Overlaps (overnight hours running into the next day) become one interval
+        if merged and a <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], b))
+        else:
+            merged.append((a, b))
+    return merged
+
+def loadhours(): # Empties hourscache once business_hours changed, checked every TZ_RECHECK seconds like the timezones
+    now = time.monotonic()
+    if now - hourscache['checked'] < TZ_RECHECK:
+        return
+    with hourscache_lock:
+        if now - hourscache['checked'] < TZ_RECHECK:
+            return
+        try:
+            with dbconn() as conn:
+                row = conn.execute("SELECT version FROM table_versions WHERE name='business_hours'").fetchone()
+            version = row[0] if row else None
+            if version is None or version != hourscache['version']:
+                hourscache['rows'] = {} # New dicts, not cleared ones, a report halfway through keeps filling the old ones
+                hourscache['compiled'] = {}
+                hourscache['version'] = version
+            hourscache['checked'] = now
+        except Exception as e:
+            logging.error("Error checking the business_hours version: %s", e) # Keep serving what we have
+
+def seedhours(cur, store_ids): # Loads the hours of the uncached stores among store_ids into hourscache, one IN (...) query
+    loadhours()
+    cache = hourscache['rows']
+    missing = [store_id for store_id in store_ids if store_id not in cache]
+    if not missing:
+        return
+    found = collections.defaultdict(list)
+    cur.execute(f"SELECT store_id, day_of_week, start_time_local, end_time_local FROM business_hours WHERE store_id IN ({','.join('?' * len(missing))})", missing)
+    for row in cur.fetchall():
+        found[row[0]].append(row[1:])
+    for store_id in missing:
+        cache[store_id] = parsehours(found.get(store_id, ())) # {} for stores without any, they're 24/7 and that's worth remembering too
+
+def storehours(store_id, lo, hi): # Open intervals of a store within [lo, hi] in UTC epoch seconds, None = open 24/7
+    if not BUSINESS_HOURS:
+        return None
+    started = time.perf_counter()
+    spent = 0.0 # The business_hours stage, lookup plus compiling, the timezone lookup in between is a stage of its own
     try:
-        cur.execute( # execute the following query in sqlite3 db
-            "SELECT timestamp_utc, status FROM store_status WHERE store_id=? AND timestamp_utc BETWEEN ? AND ? ORDER BY timestamp_utc ASC",
-            (store_id, cs.strftime("%Y-%m-%d %H:%M:%S"), ce.strftime("%Y-%m-%d %H:%M:%S"))
-        )
-        events = cur.fetchall() # Fetch all the said events
-    except sqlite3.Error as e:
-        logging.error("SQL error in calctime while fetching events for store '%s': %s", store_id, e) # Log the event by calling logging
-        conn.close()
-        return 0, 0
-
-    conn.close()
-    timeline = [] # List for allocating all the states 
-    timeline.append((cs, inic)) # Append initial chain to chain start
-    for i in events: # Loop for parsing the events 
+        loadhours()
+        byday = hourscache['rows'].get(store_id)
+        if byday is None: # First report of this store since business_hours last changed
+            try:
+                with dbconn() as conn:
+                    seedhours(conn.cursor(), [store_id])
+            except sqlite3.Error as e:
+                logging.error("SQL error fetching business hours for store '%s', assuming 24/7: %s", store_id, e)
+                return None
+            byday = hourscache['rows'].get(store_id)
+        if not byday: # No hours on file, open all the time
+            return None
+        spent = time.perf_counter() - started
+        tz = resolve_many([store_id])[store_id] # Store's timezone; if missing, America/Chicago
+        started = time.perf_counter()
+        key = (str(tz), lo, hi) # Same window and timezone as last time = same schedule, repeat reports skip the compile
+        compiled = hourscache['compiled']
+        hit = compiled.get(store_id)
+        if hit and hit[0] == key:
+            return hit[1]
+        intervals = compileschedule(byday, tz, lo, hi)
+        compiled[store_id] = (key, intervals) # One per store, a new window replaces it
+        return intervals
+    finally:
+        observe('business_hours', spent + time.perf_counter() - started)
+
+# store_status is either the original TEXT layout or the migrated epoch layout, everything reading or writing it goes through these
+def parsets(value): # store_status timestamp -> epoch seconds
+    if isinstance(value, int):
+        return value # Migrated, nothing to parse
+    return toepoch(datetime.datetime.strptime(value, TSFMT))
+
+def tsparam(ts): # epoch seconds -> what timestamp_utc compares against
+    return ts if EPOCHTS else fmtts(ts)
+
+def statuscol(): # SQL for the status column as 'active'/'inactive' text
+    return "CASE status WHEN 1 THEN 'active' ELSE 'inactive' END" if EPOCHTS else "status"
+
+def storeevent(tstext, status): # (timestamp_utc, status) values as the table stores them
+    if EPOCHTS:
+        return parsets(tstext), 1 if status == 'active' else 0
+    return tstext, status
+
+@timed('prior_query')
+def fetchprior(cur, store_id, before): # Status of the last event strictly before an epoch, None if there is none
+    cur.execute(
+        f"SELECT timestamp_utc, {statuscol()} FROM store_status WHERE store_id=? AND timestamp_utc < ? ORDER BY timestamp_utc DESC LIMIT 1",
+        (store_id, tsparam(before))
+    )
+    row = cur.fetchone()
+    return row[1] if row else None
+
+@timed('range_query')
+def fetchevents(cur, store_id, lo, hi): # Parsed (epoch, status) events with lo <= ts <= hi, ascending
+    cur.execute(
+        f"SELECT timestamp_utc, {statuscol()} FROM store_status WHERE store_id=? AND timestamp_utc BETWEEN ? AND ? ORDER BY timestamp_utc ASC",
+        (store_id, tsparam(lo), tsparam(hi))
+    )
+    timeline = []
+    for i in cur.fetchall():
         try:
-            event_time = datetime.datetime.strptime(i[0], "%Y-%m-%d %H:%M:%S")  # date-time, the first element in a event, format 
-            timeline.append((event_time, i[1])) # Append events if criteria is met
+            timeline.append((parsets(i[0]), i[1]))
         except Exception as e:
             logging.error("Error parsing event timestamp for store '%s': %s", store_id, e)
             continue
-    timeline.append((ce, None))  # End marker; state is not used.
-
-    uptime = 0
-    downtime = 0
-
-    # Parse chain, summating the durations
-    for i in range(len(timeline) - 1):
-        start, state = timeline[i] # start time 
-        end = timeline[i + 1][0] # End time
-        duration = (end - start).total_seconds() # total duration in seconds, end - start = duration
-        if state == 'active':
-            uptime += duration # increment the uptime by duration
+    return timeline
+
+def rawwindows(cur, store_id, ce, starts, hours=None): # Windows straight from store_status, only the widest one is fetched
+    cs = min(starts)
+    inic = fetchprior(cur, store_id, cs) or 'active' # Assume event is active 24/7 if there is no event
+    return sweep(fetchevents(cur, store_id, cs, ce), inic, ce, starts, hours)
+
+@timed('range_query')
+def fetchhours(cur, store_id, hours): # Parsed (epoch, status) events of a set of UTC hours, ascending, one statement whatever the number of hours
+    spans = [] # Neighbouring hours merged, fewer ORs
+    for h in sorted(hours):
+        if spans and spans[-1][1] == h:
+            spans[-1][1] = h + 3600
         else:
-            downtime += duration # increment the down time if its inactive
+            spans.append([h, h + 3600])
+    cur.execute(
+        f"SELECT timestamp_utc, {statuscol()} FROM store_status WHERE store_id=? AND ("
+        + " OR ".join(["timestamp_utc BETWEEN ? AND ?"] * len(spans)) + ") ORDER BY timestamp_utc ASC",
+        [store_id] + [tsparam(x) for a, b in spans for x in (a, b - 1)]
+    )
+    timeline = []
+    for i in cur.fetchall():
+        try:
+            timeline.append((parsets(i[0]), i[1]))
+        except Exception as e:
+            logging.error("Error parsing event timestamp for store '%s': %s", store_id, e)
+            continue
+    return timeline
 
-    return uptime, downtime
+def rollupwindows(cur, store_id, ce, starts, hours=None): # Windows out of store_status_hourly, one query for the hours and one for raw events
+    # Whole UTC hours inside an open piece are summed from the rollup, only the partial hours (window start, ce and the
+    # edges of each open interval) are swept from raw events, and those are all fetched together
+    lo = min(starts)
+    cur.execute(
+        "SELECT hour_utc, active_sec, inactive_sec, carry_status FROM store_status_hourly WHERE store_id=? AND hour_utc >= ? AND hour_utc <= ?",
+        (store_id, lo - lo % 3600, ce - ce % 3600)
+    )
+    rolled = {row[0]: row[1:] for row in cur.fetchall()}
+    first = min(rolled) if rolled else None
+    past = [] # Status past the last rolled hour, looked up at most once
+    def carry(hour): # Status in effect at the start of an hour
+        if hour in rolled:
+            return rolled[hour][2]
+        # Hours are rolled up from the store's first event to its last one, without gaps
+        if first is not None and hour < first: # Before the first event, assume event is active 24/7 if there is no event
+            return 'active'
+        if not past: # After the last event (or no hours in range at all), its status holds
+            past.append(fetchprior(cur, store_id, hour) or 'active')
+        return past[0]
+    results = []
+    partial = [] # (window, hour, a, b) pieces shorter than their hour
+    for k, ws in enumerate(starts):
+        up = down = 0
+        for a, b in clip(hours, ws, ce):
+            for h in range(a - a % 3600, b, 3600):
+                pa, pb = max(a, h), min(b, h + 3600)
+                if pa == h and pb == h + 3600:
+                    if h in rolled:
+                        up += rolled[h][0]
+                        down += rolled[h][1]
+                    elif carry(h) == 'active': # No events in the hour, the status carried in holds all of it
+                        up += 3600
+                    else:
+                        down += 3600
+                elif pb > pa:
+                    partial.append((k, h, pa, pb))
+        results.append([up, down])
+    if partial:
+        byhour = collections.defaultdict(list)
+        for ts, status in fetchhours(cur, store_id, {h for _, h, _, _ in partial}):
+            byhour[ts - ts % 3600].append((ts, status))
+        for k, h, a, b in partial:
+            state = carry(h)
+            events = []
+            for ts, status in byhour.get(h, ()):
+                if ts <= a:
+                    state = status # Status at a
+                elif ts <= b:
+                    events.append((ts, status))
+            pieceup, piecedown = sweep(events, state, b, [a])[0]
+            results[k][0] += pieceup
+            results[k][1] += piecedown
+    return [tuple(r) for r in results]
 
-def gencsv(store_id):
+def bit(bits, i): # Status bit i of a packed bitarray, 1 = active
+    return (bits[i >> 3] >> (i & 7)) & 1
+
+def appendevents(entry, rows): # Appends (rowid, timestamp_utc, status) rows, already in time order, to an index entry
+    ts, bits, upto = entry['ts'], entry['bits'], entry['upto']
+    for rowid, tstext, status in rows:
+        entry['rowid'] = max(entry['rowid'], rowid)
+        try:
+            t = parsets(tstext)
+        except Exception as e:
+            logging.error("Error parsing event timestamp for store '%s': %s", entry['store_id'], e)
+            continue
+        n = len(ts)
+        upto.append(upto[-1] + (t - ts[-1]) * bit(bits, n - 1) if n else 0) # Active seconds from the first event up to this one
+        ts.append(t)
+        if n % 8 == 0:
+            bits.append(0)
+        if status == 'active':
+            bits[n >> 3] |= 1 << (n & 7)
+
+def storeevents(store_id, reload=False): # Index entry of a store, loaded lazily and topped up with new rows, None on DB trouble
+    now = time.monotonic()
+    entry = None
+    with eventindex_lock:
+        if not reload:
+            entry = eventindex.get(store_id)
+        if entry is not None:
+            eventindex.move_to_end(store_id) # LRU
+            if now - entry['checked'] < EVENTINDEX_RECHECK:
+                return entry # Fresh enough, no SQLite at all
+    try:
+        with dbconn() as conn:
+            cur = conn.cursor()
+            if entry is None:
+                cur.execute(f"SELECT rowid, timestamp_utc, {statuscol()} FROM store_status WHERE store_id=? ORDER BY timestamp_utc, rowid", (store_id,))
+            else: # Only rows that arrived since the last look
+                cur.execute(f"SELECT rowid, timestamp_utc, {statuscol()} FROM store_status WHERE store_id=? AND rowid > ? ORDER BY timestamp_utc, rowid", (store_id, entry['rowid']))
+            rows = cur.fetchall()
+    except sqlite3.Error as e:
+        logging.error("SQL error loading the event index for store '%s': %s", store_id, e)
+        return entry # Stale beats nothing
+    global eventindex_size
+    with eventindex_lock:
+        if entry is None:
+            entry = {'store_id': store_id, 'ts': array.array('q'), 'bits': bytearray(), 'upto': array.array('q'), 'rowid': 0, 'checked': now}
+            appendevents(entry, rows)
+            old = eventindex.pop(store_id, None)
+            eventindex_size += len(entry['ts']) - (len(old['ts']) if old else 0)
+            eventindex[store_id] = entry
+        elif rows:
+            if entry['ts'] and parsets(rows[0][1]) < entry['ts'][-1]: # Backfilled history, cheaper to start over than to splice
+                rows = None
+            else:
+                before = len(entry['ts'])
+                appendevents(entry, rows)
+                eventindex_size += len(entry['ts']) - before
+        entry['checked'] = now
+        while eventindex_size > EVENTINDEX_EVENTS and len(eventindex) > 1: # Evict least recently used stores
+            _, old = eventindex.popitem(last=False)
+            eventindex_size -= len(old['ts'])
+    if rows is None:
+        return storeevents(store_id, reload=True)
+    return entry
+
+def activeupto(entry, t): # Active seconds between the first event and t (t >= first event)
+    i = bisect.bisect_right(entry['ts'], t) - 1
+    return entry['upto'][i] + (t - entry['ts'][i]) * bit(entry['bits'], i)
+
+def indexspan(entry, a, b): # Active seconds in [a, b] out of an index entry, caller holds eventindex_lock
+    first = entry['ts'][0] if entry['ts'] else None
+    if first is None or b <= first: # Nothing happened yet, assume active 24/7
+        return b - a
+    lo = max(a, first)
+    return (lo - a) + activeupto(entry, b) - activeupto(entry, lo) # Time before the first event counts as active
+
+@timed('sweep')
+def indexwindows(entry, ce, starts, hours=None): # Windows out of an index entry, two bisects per open piece instead of a sweep
+    results = []
+    with eventindex_lock: # Appends from a refresh must not land halfway through
+        for ws in starts:
+            pieces = clip(hours, ws, ce)
+            up = sum(indexspan(entry, a, b) for a, b in pieces)
+            results.append((up, sum(b - a for a, b in pieces) - up))
+    return results
+
+def calcwindows(store_id, reftime, spans, deadline=None): # Uptime and downtime for any list of trailing windows ending at reftime
+    # spans = list of timedeltas (hour, day, week, ...), results come back in the same order as (uptime, downtime) seconds
+    # deadline = see checkdeadline, looked at between the queries
+    # Short windows share one raw fetch of the widest of them, long ones are summed from the hourly rollup
+    ce = toepoch(reftime)
+    starts = [ce - int(span.total_seconds()) for span in spans]
+    hours = storehours(store_id, min(starts), ce) # Compiled once for the widest window, every window clips from it
+    checkdeadline(deadline)
+    if EVENTINDEX:
+        entry = storeevents(store_id)
+        if entry is not None:
+            return indexwindows(entry, ce, starts, hours)
+    rolled = [k for k, ws in enumerate(starts) if ROLLUP and ce - ws >= ROLLUP_MIN]
+    if rolled and not refreshrollup():
+        rolled = [] # Rollup is behind or broken, the raw path is always right
+    raw = [k for k in range(len(starts)) if k not in rolled]
+    results = [(0, 0)] * len(spans)
     try:
-        conn = dbconnect() # call function to connect to db
-        cur = conn.cursor() # make a new cursor for parsing sqlite3
+        with dbconn() as conn: # Pooled connection of this thread
+            cur = conn.cursor() # New cursor object for sqlite3
+            if raw:
+                for k, res in zip(raw, rawwindows(cur, store_id, ce, [starts[k] for k in raw], hours)):
+                    results[k] = res
+            if rolled:
+                checkdeadline(deadline)
+                for k, res in zip(rolled, rollupwindows(cur, store_id, ce, [starts[k] for k in rolled], hours)):
+                    results[k] = res
+    except TimeoutError: # Cancelled, not a failure to paper over with zeros
+        raise
+    except sqlite3.Error as e:
+        logging.error("SQL error in calcwindows for store '%s': %s", store_id, e) # log this error
+        return [(0, 0)] * len(spans)
     except Exception as e:
-        logging.error("DB error in generation of csv: %s", e) # Log this error
+        logging.error("Failed to get DB connection in calculation of uptime and downtime ,calcwindows: %s", e) # log this issue by calling logging
+        return [(0, 0)] * len(spans)
+    return results
+
+def rollstore(cur, store_id, lo): # Recomputes the hourly rows of one store from the hour holding epoch lo up to its last event
+    h0 = lo - lo % 3600
+    cur.execute("SELECT MAX(hour_utc) FROM store_status_hourly WHERE store_id=?", (store_id,))
+    last = cur.fetchone()[0]
+    if last is not None:
+        h0 = min(h0, last) # The old last hour ran its status to the hour end, gap hours after it didn't exist yet
+    cur.execute("SELECT MAX(timestamp_utc) FROM store_status WHERE store_id=?", (store_id,))
+    h1 = parsets(cur.fetchone()[0])
+    h1 -= h1 % 3600
+    state = fetchprior(cur, store_id, h0) or 'active' # Assume event is active 24/7 if there is no event
+    events = fetchevents(cur, store_id, h0, h1 + 3599)
+    rows = []
+    i = 0
+    for hour in range(h0, h1 + 3600, 3600):
+        carry = state # Status carried into this hour
+        active = inactive = 0
+        at = hour
+        while i < len(events) and events[i][0] < hour + 3600:
+            ts, status = events[i]
+            if state == 'active':
+                active += ts - at
+            else:
+                inactive += ts - at
+            at, state = ts, status
+            i += 1
+        if state == 'active': # Last status runs to the end of the hour
+            active += hour + 3600 - at
+        else:
+            inactive += hour + 3600 - at
+        rows.append((store_id, hour, active, inactive, carry))
+    cur.executemany(
+        "INSERT OR REPLACE INTO store_status_hourly (store_id, hour_utc, active_sec, inactive_sec, carry_status) VALUES (?,?,?,?,?)",
+        rows
+    )
+
+def refreshrollup(): # Folds store_status rows past the watermark into store_status_hourly, True once it is current
+    with rollup_lock: # One refresher per process, the others wait and find nothing left to do
+        try:
+            with dbconn() as conn: # One transaction, commits on the way out
+                cur = conn.cursor()
+                cur.execute("SELECT last_rowid FROM rollup_state WHERE name='store_status_hourly'")
+                row = cur.fetchone()
+                mark = row[0] if row else 0 # Watermark, every rowid up to here is rolled up
+                cur.execute("SELECT MAX(rowid) FROM store_status")
+                top = cur.fetchone()[0] or 0
+                if top <= mark:
+                    return True
+                cur.execute(
+                    "SELECT store_id, MIN(timestamp_utc) FROM store_status WHERE rowid > ? AND rowid <= ? AND store_id IS NOT NULL GROUP BY store_id",
+                    (mark, top)
+                )
+                dirty = cur.fetchall()
+                for store_id, lo in dirty:
+                    rollstore(cur, store_id, parsets(lo))
+                now = datetime.datetime.utcnow().strftime(TSFMT)
+                cur.execute(
+                    "INSERT OR REPLACE INTO rollup_state (name, last_rowid, updated_at) VALUES ('store_status_hourly', ?, ?)",
+                    (top, now)
+                )
+            logging.info("Hourly rollup caught up to row %s (%d stores updated).", top, len(dirty))
+            return True
+        except Exception as e:
+            logging.error("Error refreshing the hourly rollup: %s", e)
+            return False
+
+def rebuildrollup(): # Drops the hourly rollup and rolls up store_status from scratch
+    try:
+        with rollup_lock:
+            with dbconn() as conn:
+                conn.execute("DELETE FROM store_status_hourly")
+                conn.execute("DELETE FROM rollup_state WHERE name='store_status_hourly'")
+    except sqlite3.Error as e:
+        logging.error("Error clearing the hourly rollup: %s", e)
+        return False
+    return refreshrollup()
+
+def normts(value): # '2023-01-22 12:09:39.388884 UTC', '2023-01-22T12:09:39' and friends -> the TSFMT text store_status uses
+    value = value.strip()
+    if value.endswith(' UTC'): # Before the separator, the suffix has a T of its own
+        value = value[:-4].rstrip()
+    if len(value) > 10 and value[10] == 'T': # ISO 8601 date/time separator, only that one
+        value = value[:10] + ' ' + value[11:]
+    value = value.split('.', 1)[0] # Drop fractional seconds
+    datetime.datetime.strptime(value, TSFMT) # ValueError for anything else, garbage never reaches the table
+    return value
+
+def dropindexes(cur, table): # Drops the indexes of a table, returns their CREATE statements for rebuildindexes
+    cur.execute("SELECT name, sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL", (table,))
+    indexes = cur.fetchall()
+    for name, _ in indexes:
+        cur.execute(f'DROP INDEX "{name}"')
+    return [sql for _, sql in indexes]
+
+def ingest(table, lines, replace=False, rebuild=False, batch=INGEST_BATCH): # Streams CSV lines into a table, one transaction
+    # replace = empty the table first instead of appending, rebuild = drop its indexes during the load and rebuild them after
+    # Returns (rows, seconds)
+    columns, insert, convert = INGEST_TABLES[table]
+    started = time.monotonic()
+    reader = csv.DictReader(lines)
+    missing = [c for c in columns if c not in (reader.fieldnames or [])]
+    if missing:
+        raise ValueError(f"CSV for {table} is missing column(s): {', '.join(missing)}")
+    rows = (convert(tuple(r[c] for c in columns)) for r in reader)
+    count = 0
+    with dbconn() as conn: # Commits on the way out, rolls everything back on error
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE") # Take the write lock up front, readers carry on under WAL
+        if replace:
+            cur.execute(f"DELETE FROM {table}")
+        indexes = dropindexes(cur, table) if rebuild else []
+        while True:
+            chunk = list(itertools.islice(rows, batch))
+            if not chunk:
+                break
+            cur.executemany(insert, chunk)
+            count += len(chunk)
+        for sql in indexes:
+            cur.execute(sql)
+    seconds = time.monotonic() - started
+    logging.info("Ingested %d rows into %s in %.2fs (%.0f rows/s).", count, table, seconds, count / seconds if seconds else 0)
+    if table == 'timezones':
+        tzcache['checked'] = float('-inf') # Our own load, look at table_versions on the next lookup
+    if table == 'business_hours':
+        hourscache['checked'] = float('-inf')
+    if table == 'store_status':
+        global eventindex_size
+        with eventindex_lock: # Our own load, no need to wait out EVENTINDEX_RECHECK
+            if replace: # Every entry describes rows that are gone
+                eventindex.clear()
+                eventindex_size = 0
+            for entry in eventindex.values():
+                entry['checked'] = float('-inf')
+    if table == 'store_status' and ROLLUP: # Keep the hourly rollup in step, a replace makes the watermark meaningless
+        if replace:
+            rebuildrollup()
+        else:
+            refreshrollup()
+    return count, seconds
+
+@app.cli.command('ingest') # flask --app new_flask_app ingest store_status.csv --table store_status
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--table', type=click.Choice(sorted(INGEST_TABLES)), default='store_status', show_default=True)
+@click.option('--replace', is_flag=True, help="Empty the table before loading instead of appending.")
+@click.option('--rebuild-indexes', is_flag=True, help="Drop the table's indexes during the load and rebuild them after.")
+@click.option('--batch-size', type=int, default=INGEST_BATCH, show_default=True)
+def ingest_command(path, table, replace, rebuild_indexes, batch_size):
+    with open(path, newline='', encoding='utf-8') as f:
+        try:
+            count, seconds = ingest(table, f, replace, rebuild_indexes, batch_size)
+        except ValueError as e: # Bad header or row, nothing was loaded
+            raise click.ClickException(str(e))
+    click.echo(f"{count} rows into {table} in {seconds:.2f}s ({count / seconds if seconds else 0:.0f} rows/s)")
+
+@app.cli.command('rebuild-rollup') # flask --app new_flask_app rebuild-rollup
+def rebuild_rollup_command():
+    if not rebuildrollup():
+        raise SystemExit(1)
+    logging.info("Hourly rollup rebuilt.")
+
+def timequeries(stores): # Seconds spent on the report queries: week window of each sampled store, then the ordered fleet scan
+    with dbconn() as conn:
+        cur = conn.cursor()
+        latest = []
+        for store_id in stores:
+            cur.execute("SELECT MAX(timestamp_utc) FROM store_status WHERE store_id=?", (store_id,))
+            try:
+                latest.append((store_id, parsets(cur.fetchone()[0])))
+            except (ValueError, TypeError): # Unparseable, migrateepoch will name it, leave the store out of the timing
+                pass
+        started = time.perf_counter()
+        for store_id, ce in latest:
+            fetchprior(cur, store_id, ce - 7 * 86400)
+            fetchevents(cur, store_id, ce - 7 * 86400, ce)
+        windows = time.perf_counter() - started
+        started = time.perf_counter()
+        cur.execute(f"SELECT store_id, timestamp_utc, {statuscol()} FROM store_status WHERE store_id IS NOT NULL ORDER BY store_id, timestamp_utc")
+        for _, tstext, _ in cur:
+            try:
+                parsets(tstext)
+            except (ValueError, TypeError):
+                pass
+        scan = time.perf_counter() - started
+    return {'week windows': windows, 'fleet scan': scan}
+
+def tsepoch(value): # SQL function for migrateepoch, any timestamp normts takes -> epoch seconds, NULL if it still doesn't parse
+    try:
+        return parsets(normts(value))
+    except (ValueError, AttributeError):
+        return None
+
+def migrateepoch(): # Rewrites store_status with epoch second timestamps, 1/0 status codes and a covering index, returns rows migrated
+    # Raises ValueError, with nothing changed, when a timestamp doesn't parse: a NULL in its place would lose the original for good
+    global EPOCHTS, eventindex_size
+    with dbconn() as conn: # One transaction, a failure leaves the old table as it was
+        conn.create_function('tsepoch', 1, tsepoch, deterministic=True)
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("CREATE TABLE store_status_epoch (id INTEGER PRIMARY KEY AUTOINCREMENT, store_id TEXT, timestamp_utc INTEGER, status INTEGER)")
+        cur.execute( # Same rowids, the rollup watermark stays meaningful
+            "INSERT INTO store_status_epoch (id, store_id, timestamp_utc, status) "
+            "SELECT rowid, store_id, tsepoch(timestamp_utc), CASE status WHEN 'active' THEN 1 ELSE 0 END FROM store_status"
+        )
+        cur.execute("SELECT COUNT(*) FROM store_status_epoch")
+        count = cur.fetchone()[0]
+        cur.execute( # Rows that were NULL before stay NULL, that's no loss
+            "SELECT s.rowid, s.timestamp_utc FROM store_status_epoch e JOIN store_status s ON s.rowid = e.id "
+            "WHERE e.timestamp_utc IS NULL AND s.timestamp_utc IS NOT NULL LIMIT 5"
+        )
+        bad = cur.fetchall()
+        if bad:
+            raise ValueError(f"Unparseable timestamp_utc in store_status, e.g. {', '.join(f'rowid {i}: {ts!r}' for i, ts in bad)}; fix or delete those rows, nothing was migrated.")
+        cur.execute("DROP TABLE store_status") # Takes idx_store_status_store_ts with it
+        cur.execute("ALTER TABLE store_status_epoch RENAME TO store_status")
+        # Covers every report query, they never touch the table itself
+        cur.execute("CREATE INDEX idx_store_status_covering ON store_status (store_id, timestamp_utc, status)")
+        EPOCHTS = True
+    with eventindex_lock:
+        eventindex.clear()
+        eventindex_size = 0
+    if ROLLUP:
+        rebuildrollup()
+    with dbconn() as conn:
+        conn.execute("ANALYZE")
+        conn.execute("VACUUM") # Hand back the pages of the old table
+    return count
+
+@app.cli.command('migrate-epoch') # flask --app new_flask_app migrate-epoch
+@click.option('--sample', type=int, default=MIGRATE_SAMPLE, show_default=True, help="Stores to time the window queries on.")
+def migrate_epoch_command(sample):
+    with dbconn() as conn:
+        detectformat(conn)
+    if EPOCHTS:
+        click.echo("store_status already holds epoch timestamps.")
+        return
+    with dbconn() as conn:
+        stores = [r[0] for r in conn.execute(
+            "SELECT store_id FROM (SELECT DISTINCT store_id FROM store_status WHERE store_id IS NOT NULL) ORDER BY random() LIMIT ?", (sample,)
+        )]
+    before = timequeries(stores)
+    started = time.monotonic()
+    try:
+        count = migrateepoch()
+    except ValueError as e: # Rolled back, store_status is as it was
+        raise click.ClickException(str(e))
+    click.echo(f"Migrated {count} rows in {time.monotonic() - started:.2f}s")
+    after = timequeries(stores)
+    for name in before:
+        click.echo(f"{name:<14} before {before[name]:8.3f}s  after {after[name]:8.3f}s  ({before[name] / after[name] if after[name] else 0:.1f}x)")
+    click.echo("Restart any app processes that were running, they keep using the old layout until then.")
+
+def calctime(store_id, cs, ce): # Calculation of uptime or downtime for a single chain
+    # cs = chain start
+    # ce = chain end
+    return calcwindows(store_id, ce, [ce - cs])[0]
+
+def gencsv(store_id):
+    row = storerow(store_id)
+    if row is None:
         return None
+    return ''.join(csvchunks([row]))  # Output the csv
 
+def storerow(store_id, deadline=None): # Report row of one store, None on DB trouble; raises TimeoutError past deadline
     try:
-        cur.execute("SELECT MAX(timestamp_utc) FROM store_status WHERE store_id=?", (store_id,)) # get latest timestamp
-        row = cur.fetchone() # iterates till none in db
+        entry = storeevents(store_id) if EVENTINDEX else None
+        if entry is not None: # Latest timestamp straight from the index
+            row = (entry['ts'][-1],) if entry['ts'] else None
+        else:
+            with dbconn() as conn: # Pooled connection of this thread
+                cur = conn.cursor() # make a new cursor for parsing sqlite3
+                cur.execute("SELECT MAX(timestamp_utc) FROM store_status WHERE store_id=?", (store_id,)) # get latest timestamp
+                row = cur.fetchone() # iterates till none in db
     except sqlite3.Error as e:
         logging.error("SQL error while fetching latest timestamp for store '%s': %s", store_id, e) # log by calling the function
-        conn.close() # close connection after displaying error
         return None
 
     try:
         if row and row[0]: # check the elements in row and the 1st element of row
-            reftime = datetime.datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S") # get 1st element and format it 
+            reftime = EPOCH + datetime.timedelta(seconds=parsets(row[0])) # get 1st element and format it 
             # reftime = reference time
         else:
             reftime = datetime.datetime.utcnow() # if not? it'll take the current universal time
@@ -134,131 +1060,715 @@ def gencsv(store_id):
     except Exception as e:
         logging.error("Error parsing timestamp for store '%s': %s", store_id, e) # Log this error but keep refrence time to the current universal time
         reftime = datetime.datetime.utcnow()
-    conn.close() # Close this connection
-    # Get the store's timezone; if missing, default to America/Chicago.
-    tz_str = getz(store_id)
+
+    # Calculate up-down time in seconds, hour, day and week in a single pass, business hours only
+    return csvrow(store_id, calcwindows(store_id, reftime, WINDOWS, deadline))
+
+def csvchunks(rows, size=None): # CSV text in chunks of about size characters, header first, whatever the number of rows
+    size = size or CSV_CHUNK
+    output = io.StringIO() # Only ever holds one chunk
+    writer = csv.writer(output)
+    writer.writerow(CSVHEADER)  # Write this whole thing as the benchmark legends
+    spent = 0.0 # Encoding only, not the time spent computing rows
+    for row in rows:
+        started = time.perf_counter()
+        writer.writerow(row) # Actual data
+        spent += time.perf_counter() - started
+        if output.tell() >= size:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    if output.tell():
+        yield output.getvalue()
+    observe('csv_encode', spent)
+
+def iterreport(store_id, stores=None, deadline=None): # CSV chunks of a report as they are computed, raises if the report can't be built
+    # deadline = see checkdeadline, every store's row looks at it
+    if stores:
+        yield from csvchunks(batchrows(stores, deadline))
+        return
+    if store_id == ALLSTORES:
+        yield from csvchunks(fleetrows(deadline))
+        return
+    row = storerow(store_id, deadline)
+    if row is None:
+        raise Exception("CSV generation failed (returned None).")
+    yield from csvchunks([row])
+
+def csvrow(store_id, windows): # One report row out of the (uptime, downtime) seconds of every REPORT_WINDOWS window, CSVHEADER order
+    units = [UNITS[unit] for _, _, unit in REPORT_WINDOWS] # hour window in minutes, day and week in hours
+    # round up everything to 2 decimals
+    return (
+        [store_id]
+        + [round(up / per, 2) for (up, _), per in zip(windows, units)]
+        + [round(down / per, 2) for (_, down), per in zip(windows, units)]
+    )
+
+def scanstores(rows, spans, hours=None, deadline=None): # Per-store windows out of a (store_id, timestamp_utc, status) stream sorted by store, then time
+    # hours = how to get a store's open intervals, storehours unless the caller already has them; deadline = see checkdeadline
+    # Only one store is held at a time, and only its events that can still land in the widest window
+    widest = max(int(span.total_seconds()) for span in spans)
+    for store_id, group in itertools.groupby(rows, key=lambda r: r[0]):
+        checkdeadline(deadline)
+        inic = 'active' # Assume event is active 24/7 if there is no event
+        events = collections.deque()
+        for _, tstext, status in group:
+            try:
+                ts = parsets(tstext)
+            except Exception as e:
+                logging.error("Error parsing event timestamp for store '%s': %s", store_id, e)
+                continue
+            events.append((ts, status))
+            while events[0][0] < ts - widest: # Too old for any window of this store, keep only its status
+                inic = events.popleft()[1]
+        if not events:
+            continue
+        ce = events[-1][0] # Latest event is the reference time, same as MAX(timestamp_utc) in gencsv
+        yield store_id, sweep(events, inic, ce, [ce - int(span.total_seconds()) for span in spans], (hours or storehours)(store_id, ce - widest, ce))
+
+def chunks(store_ids): # Slices of at most IN_CHUNK store IDs
+    for i in range(0, len(store_ids), IN_CHUNK):
+        yield store_ids[i:i + IN_CHUNK]
+
+def batchkey(store_ids): # store_id a batch report goes by, the same list always gets the same one
+    return BATCH + hashlib.sha1('\n'.join(store_ids).encode('utf-8')).hexdigest()[:16]
+
+def batchrows(store_ids, deadline=None): # Report rows of a list of stores in store_id order, events, hours and timezones fetched IN_CHUNK stores at a time
+    for chunk in chunks(sorted(set(store_ids))):
+        marks = ','.join('?' * len(chunk))
+        resolve_many(chunk)
+        rows = {}
+        with dbconn() as conn:
+            cur = conn.cursor()
+            if BUSINESS_HOURS:
+                seedhours(cur, chunk) # storehours finds the whole chunk cached
+            cur.execute(f"SELECT store_id, timestamp_utc, {statuscol()} FROM store_status WHERE store_id IN ({marks}) ORDER BY store_id, timestamp_utc", chunk)
+            for store_id, windows in scanstores(cur, WINDOWS, storehours, deadline):
+                rows[store_id] = csvrow(store_id, windows)
+        for store_id in chunk:
+            row = rows.get(store_id) or storerow(store_id, deadline) # No events at all, same row gencsv gives it
+            if row is None:
+                raise sqlite3.Error(f"Couldn't compute the row of store '{store_id}'.")
+            yield row
+
+def fleetrows(deadline=None): # Fleet report rows, one per store out of a single ordered scan of store_status (or one per shard on the process pool)
+    if PROCESSES > 1:
+        try:
+            yield from parallelrows(deadline)
+        except concurrent.futures.process.BrokenProcessPool as e:
+            logging.error("Report process pool died during the fleet report: %s", e)
+            resetprocpool()
+            raise
+        return
+    with dbconn() as conn:
+        cur = conn.cursor()
+        started = time.perf_counter()
+        cur.execute(f"SELECT store_id, timestamp_utc, {statuscol()} FROM store_status WHERE store_id IS NOT NULL ORDER BY store_id, timestamp_utc") # Streamed row by row, never fetchall
+        observe('range_query', time.perf_counter() - started) # Up to the first row, the rest streams in with the sweeps
+        for store_id, windows in scanstores(cur, WINDOWS, deadline=deadline):
+            yield csvrow(store_id, windows)
+
+def planshards(counts, n): # Splits (store_id, event count) pairs into n shards of about equal event count
+    # Largest store first onto the lightest shard, so one huge store can't leave the rest of the pool idle
+    shards = [[] for _ in range(n)]
+    loads = [(0, k) for k in range(n)]
+    for store_id, count in sorted(counts, key=lambda c: c[1], reverse=True):
+        load, k = heapq.heappop(loads)
+        shards[k].append(store_id)
+        heapq.heappush(loads, (load + count, k))
+    return [shard for shard in shards if shard]
+
+def readonlyworker(): # Initializer of the report processes, they only ever read
+    global READONLY, schema_ready
+    READONLY = True
+    schema_ready = True # The parent already prepared the schema
+
+def shardrows(store_ids, budget=None): # Runs in a report process, CSV rows for a shard of stores in store_id order
+    # budget = seconds the report has left, monotonic clocks of different processes aren't comparable so it goes over as a duration
+    deadline = None if budget is None else time.monotonic() + budget
+    with dbconn() as conn:
+        rows = itertools.chain.from_iterable(
+            conn.execute(f"SELECT store_id, timestamp_utc, {statuscol()} FROM store_status WHERE store_id=? ORDER BY timestamp_utc", (store_id,))
+            for store_id in sorted(store_ids)
+        )
+        return [csvrow(store_id, windows) for store_id, windows in scanstores(rows, WINDOWS, deadline=deadline)]
+
+def getprocpool(): # Report process pool, started on the first parallel report
+    global procpool
+    with procpool_lock:
+        if procpool is None:
+            # spawn, forking a process full of Flask and worker threads is asking for a deadlock
+            procpool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=PROCESSES, mp_context=multiprocessing.get_context('spawn'), initializer=readonlyworker
+            )
+        return procpool
+
+def resetprocpool(): # Drops a broken pool, the next parallel report starts a new one
+    global procpool
+    with procpool_lock:
+        if procpool is not None:
+            procpool.shutdown(wait=False, cancel_futures=True)
+        procpool = None
+
+def parallelrows(deadline=None): # Fleet rows from the process pool, merged back into store_id order
+    with dbconn() as conn:
+        counts = conn.execute("SELECT store_id, COUNT(*) FROM store_status WHERE store_id IS NOT NULL GROUP BY store_id").fetchall()
+    shards = planshards(counts, PROCESSES * SHARDS_PER_PROCESS)
+    left = lambda: None if deadline is None else max(0.0, deadline - time.monotonic())
+    futures = [getprocpool().submit(shardrows, shard, left()) for shard in shards]
     try:
-        local_tz = pytz.timezone(tz_str)
-        # Convert reftime from UTC to the store's local time
-        reftime_local = reftime.replace(tzinfo=pytz.utc).astimezone(local_tz).replace(tzinfo=None)
-    except Exception as e:
-        logging.error("Error converting reftime to local timezone for store '%s': %s", store_id, e)
-        reftime_local = reftime
-
-    hrstart = reftime - datetime.timedelta(hours=1) # start chain by hours
-    daystart = reftime - datetime.timedelta(days=1) # start chain by day
-    weekstart = reftime - datetime.timedelta(weeks=1) # start chain by week
-
-    # Calculate up-down time in seconds
-    uphrsec, dwhrsec = calctime(store_id, hrstart, reftime)  # hour
-    updaysec, dwdaysec = calctime(store_id, daystart, reftime) # day
-    upweeksec, dwweeksec = calctime(store_id, weekstart, reftime) # week
-
-    # round up everything to 2 decimals 
-    # 1hr = 3600 secs
-    uphrmin = round(uphrsec / 60.0, 2) # (for hours) uptime hours -> mins 
-    dwhrmin = round(dwhrsec / 60.0, 2)  # (for hours) downtime hours -> mins 
-    updaymin = round(updaysec / 3600.0, 2) # (for days) uptime days -> hours
-    dwdayhr = round(dwdaysec / 3600.0, 2)  # (for days) downtime days -> hours
-    upweekhr = round(upweeksec / 3600.0, 2) # (for week) uptime week -> hours 
-    dwweekhr = round(dwweeksec / 3600.0, 2) # (for week) downtime week -> hours
-
-    # Making CSV? like, making the structure that gets appended to the csv
-    output = io.StringIO() # For dynamic writing abilities, store in mem instead of disk
-    writer = csv.writer(output) 
-    writer.writerow([  
-        "store_id", "uptime_last_hour(min)", "uptime_last_day(hrs)",
-        "uptime_last_week(hrs)", "downtime_last_hour(min)",
-        "downtime_last_day(hrs)", "downtime_last_week(hrs)"
-    ])  # Write this whole thing as the benchmark legends
-    writer.writerow([
-        store_id, uphrmin, updaymin, upweekhr,
-        dwhrmin, dwdayhr, dwweekhr
-    ]) # Actual data
-
-    return output.getvalue()  # Output the csv
-
-def storerep(repid, store_id, repdata): # Was this necessary ? May be for company's reference?
+        _, waiting = concurrent.futures.wait(futures, timeout=left()) # Every shard has to be in before the merge can start
+        if waiting:
+            raise TimeoutError("Cancelled, ran past its budget.")
+        yield from heapq.merge(*(f.result() for f in futures), key=lambda r: r[0])
+    finally:
+        for f in futures: # A cancelled report leaves none of its shards queued behind it
+            f.cancel()
+
+def writerep(repid, chunks): # Writes the CSV chunks to the report directory, returns (path, size on disk, encoding, seconds spent writing)
+    encoding = 'gzip' if REPORT_COMPRESS else None
+    path = os.path.join(REPORT_DIR, f"{repid}.csv.gz" if encoding else f"{repid}.csv")
+    tmp = path + '.tmp' # Renamed once complete, nobody ever sees half a report
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    spent = 0.0 # Opening, writing, closing and renaming; pulling the chunks is the report being computed
     try:
-        conn = dbconnect()
-        cur = conn.cursor()
-        now = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-        cur.execute("INSERT INTO reports (report_id, store_id, repdata, generated_at) VALUES (?,?,?,?)",(repid, store_id, repdata, now))
-        conn.commit()
-        conn.close()
-        logging.info("Report %s stored in the database.", repid)
+        opener = gzip.open if encoding else open
+        started = time.perf_counter()
+        with opener(tmp, 'wt', encoding='utf-8', newline='') as f:
+            spent += time.perf_counter() - started
+            for chunk in chunks:
+                started = time.perf_counter()
+                f.write(chunk)
+                spent += time.perf_counter() - started
+            started = time.perf_counter() # Closing flushes what's left
+        os.replace(tmp, path)
+        spent += time.perf_counter() - started
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return path, os.path.getsize(path), encoding, spent
+
+def storerep(repid, store_id, repdata): # Stores a report (text or an iterable of CSV chunks) as a file plus its row, True once it's in
+    path = None
+    try:
+        if isinstance(repdata, str):
+            repdata = [repdata]
+        path, size, encoding, spent = writerep(repid, repdata)
+        started = time.perf_counter()
+        with dbconn() as conn: # Commits on the way out
+            cur = conn.cursor()
+            now = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+            cur.execute( # OR REPLACE, a job retried after a lost lease writes the same report again
+                "INSERT OR REPLACE INTO reports (report_id, store_id, repdata, generated_at, path, size, encoding) VALUES (?,?,NULL,?,?,?,?)",
+                (repid, store_id, now, path, size, encoding)
+            )
+        observe('store', spent + time.perf_counter() - started) # File and row, not the computing that fed the file
+        logging.info("Report %s stored at %s (%d bytes).", repid, path, size)
+        return True
+    except TimeoutError: # Cancelled by its budget half way through, writerep already dropped the file, buildrep records why
+        raise
     except Exception as e:
         logging.error("Error storing report %s for store %s: %s", repid, store_id, e)
-        
-def fetchrep(repid):
+        if path and os.path.exists(path): # No row points at it
+            os.remove(path)
+        return False
+
+def openrep(repid): # (rowid, path, size in bytes, encoding) of a stored report, path is None for reports kept in repdata
     try:
-        conn = dbconnect()
-        cur = conn.cursor()
-        cur.execute("SELECT repdata FROM reports WHERE report_id=?", (repid,))
-        row = cur.fetchone()
-        conn.close()
-        if row:
-            return row[0]
-        else:
+        with dbconn() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT rowid, path, CASE WHEN path IS NULL THEN length(CAST(repdata AS BLOB)) ELSE size END, encoding "
+                "FROM reports WHERE report_id=? AND (path IS NOT NULL OR repdata IS NOT NULL)", (repid,)
+            )
+            row = cur.fetchone()
+        if row and row[1] and not os.path.exists(row[1]):
+            logging.error("Report %s points at %s, which is gone.", repid, row[1])
             return None
+        return row
     except Exception as e:
-        logging.error("Error fetching report %s from database: %s", repid, e)
+        logging.error("Error looking up report %s in the database: %s", repid, e)
         return None
 
-def buildrep(repid, store_id): # to build the csv
+def streamfile(path): # Plain CSV bytes of a gzipped report file, for clients that don't take gzip
+    with gzip.open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CSV_CHUNK)
+            if not chunk:
+                break
+            yield chunk
+
+def streamrep(rowid, compress=False): # Bytes of a stored report (gzipped when compress), read CSV_CHUNK at a time straight out of the row
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None # wbits 31 = gzip framing
+    with dbconn() as conn:
+        with conn.blobopen('reports', 'repdata', rowid, readonly=True) as blob:
+            while True:
+                chunk = blob.read(CSV_CHUNK)
+                if not chunk:
+                    break
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                    if not chunk:
+                        continue
+                yield chunk
+    if compressor:
+        yield compressor.flush()
+
+def dataver(store_id, stores=None): # Version of the data a report is computed from
+    # (MAX(timestamp_utc), row count, timezones version, business_hours version), a changed timezone or opening hour is new data too
+    try:
+        with dbconn() as conn:
+            cur = conn.cursor()
+            cur.execute(f"SELECT name, version FROM table_versions WHERE name IN ({','.join('?' * len(VERSIONED))})", VERSIONED)
+            tables = dict(cur.fetchall())
+            versions = tuple(tables.get(table, 0) for table in VERSIONED)
+            if stores: # Batch, added up over the chunks
+                latest, count = None, 0
+                for chunk in chunks(stores):
+                    cur.execute(f"SELECT MAX(timestamp_utc), COUNT(*) FROM store_status WHERE store_id IN ({','.join('?' * len(chunk))})", chunk)
+                    top, n = cur.fetchone()
+                    if top is not None and (latest is None or top > latest):
+                        latest = top
+                    count += n
+                return (latest, count) + versions
+            if store_id == ALLSTORES:
+                cur.execute("SELECT MAX(timestamp_utc), COUNT(*) FROM store_status")
+            else:
+                cur.execute("SELECT MAX(timestamp_utc), COUNT(*) FROM store_status WHERE store_id=?", (store_id,))
+            row = cur.fetchone()
+        return tuple(row) + versions
+    except Exception as e:
+        logging.error("Error fetching data version for store '%s': %s", store_id, e)
+        return None
+
+def verkey(ver): # dataver() tuple -> report_jobs.data_version text, None when there is no version to match on
+    return None if ver is None else '|'.join(str(part) for part in ver)
+
+def findjob(cur, store_id, ver): # (report_id, state, lane) of the job that already answers this store's data: Pending, Running, or Complete within REPORT_CACHE_TTL
+    cutoff = (datetime.datetime.utcnow() - datetime.timedelta(seconds=REPORT_CACHE_TTL)).strftime(TSFMT)
+    cur.execute(
+        "SELECT report_id, state, lane FROM report_jobs WHERE store_id=? AND data_version=? "
+        "AND (state IN ('Pending', 'Running') OR (state='Complete' AND finished_at >= ?)) ORDER BY created_at DESC LIMIT 1",
+        (store_id, ver, cutoff)
+    )
+    return cur.fetchone()
+
+def demoted(job, lane): # True when an interactive trigger found its report still Pending in the bulk lane (a prewarm job, usually)
+    return lane == 'interactive' and job[1] == 'Pending' and job[2] == 'bulk'
+
+def pricejob(store_id, stores, data): # (estimated cost in status rows, lane) of a report, data is its dataver() tuple
+    cost = data[1] if data else None
+    if cost is None: # No count to go by, fleet and batch reports are the expensive kind
+        return None, 'bulk' if stores or store_id == ALLSTORES else 'interactive'
+    return cost, 'bulk' if cost >= BULK_EVENTS else 'interactive'
+
+def enqueuejob(store_id, ver, stores=None, profiled=False, lane='interactive', cost=None, client=None):
+    # (repid, created) of the job for this store's data, (None, 'full') when the lane's queue is full, (None, 'client') when client is at its limit
+    # profiled jobs always run, attaching to someone else's report wouldn't profile anything
+    with dbconn() as conn:
+        cur = conn.cursor()
+        job = findjob(cur, store_id, ver) if ver and not profiled else None # Plain read first, most repeats end here
+        if job and not demoted(job, lane):
+            return job[0], False
+        cur.execute("BEGIN IMMEDIATE") # Look again and insert under the write lock, two processes can't both create it
+        job = findjob(cur, store_id, ver) if ver and not profiled else None
+        if job: # Attaching costs nothing, no limits apply
+            if demoted(job, lane): # Somebody is waiting on it now, it goes ahead of the fleet and batch reports
+                cur.execute("UPDATE report_jobs SET lane='interactive' WHERE report_id=? AND state='Pending'", (job[0],))
+            return job[0], False
+        cur.execute("SELECT COUNT(*) FROM report_jobs WHERE state='Pending'")
+        if cur.fetchone()[0] >= (max(1, QUEUE_DEPTH // 2) if lane == 'bulk' else QUEUE_DEPTH): # Bulk gets half the queue, the rest is kept for interactive
+            return None, 'full'
+        if client:
+            cur.execute("SELECT COUNT(*), TOTAL(lane='bulk') FROM report_jobs WHERE client=? AND state IN ('Pending', 'Running')", (client,))
+            mine, bulk = cur.fetchone()
+            if mine >= CLIENT_JOBS or (lane == 'bulk' and bulk >= CLIENT_BULK_JOBS):
+                return None, 'client'
+        repid = str(uuid.uuid4()) # assigning unique id for every report
+        cur.execute(
+            "INSERT INTO report_jobs (report_id, store_id, data_version, state, created_at, stores, profiled, lane, cost, client) "
+            "VALUES (?,?,?,'Pending',?,?,?,?,?,?)",
+            (repid, store_id, ver, datetime.datetime.utcnow().strftime(TSFMT), json.dumps(stores) if stores else None, int(profiled), lane, cost, client)
+        )
+    return repid, True
+
+def claimjob(bulk=True): # Atomically hands the next job to this process, (repid, store_id, data_version, stores JSON, profiled, lane) or None
+    # Interactive jobs first, then oldest first; bulk=False leaves bulk jobs for workers with a bulk slot
+    now = time.time()
+    stamp = datetime.datetime.utcnow().strftime(TSFMT)
+    with dbconn() as conn:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE") # One claimer at a time across every process
+        cur.execute( # Lost their worker too often, stop handing them out
+            "UPDATE report_jobs SET state='Error', error='Worker lost too many times', finished_at=?, lease_until=NULL "
+            "WHERE state='Running' AND lease_until < ? AND attempts >= ?",
+            (stamp, now, JOB_ATTEMPTS)
+        )
+        cur.execute( # Pending jobs and Running jobs whose lease ran out (their process died)
+            "UPDATE report_jobs SET state='Running', owner=?, lease_until=?, attempts=attempts + 1, started_at=? "
+            "WHERE report_id = (SELECT report_id FROM report_jobs WHERE (state='Pending' OR (state='Running' AND lease_until < ?)) AND (? OR lane != 'bulk') "
+            "ORDER BY lane = 'bulk', created_at LIMIT 1) "
+            "RETURNING report_id, store_id, data_version, stores, profiled, lane",
+            (owner(), now + JOB_LEASE, stamp, now, int(bulk))
+        )
+        rows = cur.fetchall()
+    if rows:
+        notifyjobs() # Pending -> Running
+    return rows[0] if rows else None
+
+def finishjob(repid, state, error=None, profile=None): # Records how a claimed job ended, False if another process took it over meanwhile
+    with dbconn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE report_jobs SET state=?, error=?, finished_at=?, lease_until=NULL, profile=?, "
+            "result=(SELECT path FROM reports WHERE report_id=?) WHERE report_id=? AND owner=?",
+            (state, error, datetime.datetime.utcnow().strftime(TSFMT), profile, repid, repid, owner())
+        )
+        done = cur.rowcount == 1
+    with metrics_lock:
+        finished[state] += 1
+    notifyjobs()
+    return done
+
+def notifyjobs(): # Wakes everyone in waitjob
+    global jobgen
+    with jobcond:
+        jobgen += 1
+        jobcond.notify_all()
+
+def waitjob(repid, seen, timeout): # Blocks until the job's state is no longer seen or timeout seconds pass, returns jobstate()
+    deadline = time.monotonic() + timeout
+    while True:
+        with jobcond:
+            gen = jobgen
+        job = jobstate(repid)
+        if job is None or job[0] != seen:
+            return job
+        left = deadline - time.monotonic()
+        if left <= 0:
+            return job
+        with jobcond:
+            if jobgen == gen: # Nothing changed since the lookup, sleep until something does
+                jobcond.wait(min(left, JOB_POLL)) # Jobs run by other processes don't notify us, look again every JOB_POLL
+
+def jobstate(repid): # (state, error) of a report job, None if there is no such job
+    try:
+        with dbconn() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT state, error FROM report_jobs WHERE report_id=?", (repid,))
+            return cur.fetchone()
+    except sqlite3.Error as e:
+        logging.error("Error looking up report job %s: %s", repid, e)
+        return None
+
+def profilesummary(profiler): # Top of a cProfile run by cumulative time, as text
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_LINES)
+    return out.getvalue()
+
+def buildrep(repid, store_id, stores=None, profiled=False, budget=0): # to build the csv, the job is already claimed (Running) by this process; True once Complete
+    profiler = cProfile.Profile() if profiled else None
     try:
-        with reports_lock: # Lock cpu for one process (edge case?)
-            reports[repid]['state'] = 'Running' 
         logging.info("Report %s for store '%s' is now running.", repid, store_id) # Log this too, imp**
-        repdata = gencsv(store_id) # call function
-        if repdata is None: # If it returns None
-            raise Exception("CSV generation failed (returned None).") 
-        with reports_lock: # lock report to ensure only one process access the db
-            reports[repid]['repdata'] = repdata # Dictionary with key report report ID and object report data = report data
-            reports[repid]['state'] = 'Complete' # Mark it as complete if done
-        storerep(repid, store_id, repdata)
+        if profiler:
+            profiler.enable()
+        try:
+            # Every store checks the deadline, a report past its budget stops where it is (TimeoutError) instead of running to the end
+            stored = storerep(repid, store_id, iterreport(store_id, stores, time.monotonic() + budget if budget else None)) # Generated chunk by chunk straight into storage
+        except TimeoutError:
+            raise Exception(f"Cancelled, ran past its budget of {budget:g}s.")
+        finally:
+            if profiler:
+                profiler.disable()
+        if not stored:
+            raise Exception("Report could not be stored.")
+        if not finishjob(repid, 'Complete', profile=profilesummary(profiler) if profiler else None): # Mark it as complete once it can be served
+            logging.error("Report %s was taken over by another worker while it ran.", repid)
+            return False
         logging.info("Report %s for store '%s' completed successfully.", repid, store_id) # Log it as success
+        return True
     except Exception as e:
         error_msg = f"Error processing report {repid} for store '{store_id}': {e}" # Processing error
         logging.error(error_msg)
-        with reports_lock:
-            reports[repid]['state'] = 'Error' 
-            reports[repid]['repdata'] = None # Error gives out None datatype
+        try:
+            finishjob(repid, 'Error', str(e), profilesummary(profiler) if profiler else None)
+        except sqlite3.Error as e:
+            logging.error("Couldn't mark report %s as failed: %s", repid, e) # The lease runs out and it gets retried
+        return False
             
-@app.route('/trigger_report', methods=['GET']) # /trigger_report api route , allows GET method
+def cachedrep(key): # repid of a finished report computed from exactly this data, caller holds reports_lock
+    hit = repcache.get(key)
+    if hit is None:
+        return None
+    if hit['expires'] < time.monotonic(): # TTL, stale entries go on lookup
+        del repcache[key]
+        return None
+    repcache.move_to_end(key) # LRU
+    return hit['repid']
+
+def cacherep(key, repid): # Remembers a finished report, caller holds reports_lock
+    repcache[key] = {'repid': repid, 'expires': time.monotonic() + REPORT_CACHE_TTL}
+    repcache.move_to_end(key)
+    while len(repcache) > REPORT_CACHE_ENTRIES: # Bounded, least recently used goes first
+        repcache.popitem(last=False)
+
+def worker(): # Report worker, claims jobs out of report_jobs for the life of the process
+    global busy, bulkbusy
+    while True:
+        try:
+            with claim_lock: # Claims are serialised by BEGIN IMMEDIATE anyway, two workers can't both squeeze into the last bulk slot
+                with metrics_lock:
+                    bulk = bulkbusy < BULK_WORKERS
+                job = claimjob(bulk)
+                if job is not None and job[5] == 'bulk': # Counted once it's really ours, idle workers hold no slot
+                    with metrics_lock:
+                        bulkbusy += 1
+        except sqlite3.Error as e:
+            logging.error("Couldn't claim a report job: %s", e)
+            job = None
+        if job is None:
+            jobready.acquire(timeout=JOB_POLL) # A local trigger wakes us, jobs from other processes get picked up on the timeout
+            continue
+        repid, store_id, ver, stores, profiled, lane = job
+        with metrics_lock:
+            busy += 1
+        try:
+            if buildrep(repid, store_id, json.loads(stores) if stores else None, bool(profiled), BUDGETS.get(lane, 0)) and ver:
+                with reports_lock:
+                    cacherep((store_id, ver), repid) # Same data next time = same report, without asking the database
+        except Exception as e:
+            logging.error("Report worker failed on report %s: %s", repid, e)
+        finally:
+            with metrics_lock:
+                busy -= 1
+                if lane == 'bulk':
+                    bulkbusy -= 1
+
+def heartbeat(): # Keeps the leases of this process's Running jobs from running out while they build
+    while True:
+        time.sleep(JOB_LEASE / 3)
+        try:
+            with dbconn() as conn:
+                conn.execute("UPDATE report_jobs SET lease_until=? WHERE owner=? AND state='Running'", (time.time() + JOB_LEASE, owner()))
+        except sqlite3.Error as e:
+            logging.error("Couldn't renew report job leases: %s", e)
+
+def sweepreports(): # Purges reports and finished jobs past REPORT_RETENTION in batches, then hands free pages back; returns rows purged
+    # Never younger than REPORT_CACHE_TTL, a trigger may still be handing those report IDs out
+    cutoff = (datetime.datetime.utcnow() - datetime.timedelta(seconds=max(REPORT_RETENTION, REPORT_CACHE_TTL))).strftime(TSFMT)
+    purged = 0
+    gone = set()
+    while True:
+        with dbconn() as conn: # One short transaction per batch
+            cur = conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute("SELECT report_id, path FROM reports WHERE generated_at < ? LIMIT ?", (cutoff, SWEEP_BATCH))
+            rows = cur.fetchall()
+            cur.executemany("DELETE FROM reports WHERE report_id=?", [(repid,) for repid, _ in rows])
+            cur.execute(
+                "DELETE FROM report_jobs WHERE rowid IN "
+                "(SELECT rowid FROM report_jobs WHERE finished_at < ? AND state IN ('Complete', 'Error') LIMIT ?)",
+                (cutoff, SWEEP_BATCH)
+            )
+            jobs = cur.rowcount
+        for repid, path in rows: # After the commit, a crash in between leaves a stray file rather than a row pointing nowhere
+            if path:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            gone.add(repid)
+        purged += len(rows) + jobs
+        if len(rows) < SWEEP_BATCH and jobs < SWEEP_BATCH:
+            break
+    if gone:
+        with reports_lock: # Nobody gets handed a purged report from memory either
+            for key in [key for key, hit in repcache.items() if hit['repid'] in gone]:
+                del repcache[key]
+    with dbconn() as conn:
+        conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall() # A no-op until the database is in incremental mode
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall() # Keeps the WAL from growing under steady writes
+    if purged:
+        logging.info("Purged %d expired report rows (%d report files).", purged, len(gone))
+    return purged
+
+def sweeper(): # Runs sweepreports every SWEEP_EVERY seconds for the life of the process
+    while REPORT_RETENTION:
+        try:
+            sweepreports()
+        except Exception as e:
+            logging.error("Report retention sweep failed: %s", e)
+        time.sleep(SWEEP_EVERY)
+
+def noteheat(store_id): # Counts one trigger of store_id, older triggers fade out with HEAT_HALFLIFE
+    now = time.monotonic()
+    with heat_lock:
+        entry = heat.get(store_id)
+        if entry is None:
+            heat[store_id] = [1.0, now]
+        else:
+            entry[0] = entry[0] * 0.5 ** ((now - entry[1]) / HEAT_HALFLIFE) + 1
+            entry[1] = now
+
+def hotstores(): # Up to PREWARM_STORES store_ids triggered at least PREWARM_MIN times lately, hottest first
+    now = time.monotonic()
+    with heat_lock:
+        scores = {store_id: count * 0.5 ** ((now - last) / HEAT_HALFLIFE) for store_id, (count, last) in heat.items()}
+        if len(heat) > HEAT_ENTRIES: # Bounded, the coldest stores are forgotten
+            for store_id in heapq.nsmallest(len(heat) - HEAT_ENTRIES, scores, key=scores.get):
+                del heat[store_id]
+    return [store_id for store_id in heapq.nlargest(PREWARM_STORES, scores, key=scores.get) if scores[store_id] >= PREWARM_MIN]
+
+def prewarmpass(rnd): # One round over the hot stores, queues a job for each store whose data has no fresh report; returns jobs queued
+    global prewarmed
+    # Random offsets over the first half of the round, the hot stores (and the processes sharing the database) don't all hit the workers at once
+    plan = sorted((rnd.uniform(0, PREWARM_EVERY / 2), store_id) for store_id in hotstores())
+    queued, at = 0, 0.0
+    for offset, store_id in plan:
+        time.sleep(offset - at)
+        at = offset
+        data = dataver(store_id)
+        ver = verkey(data)
+        if ver is None:
+            continue
+        with reports_lock:
+            if cachedrep((store_id, ver)): # Already built from this data
+                continue
+        # Attaches to a Pending/Running/fresh Complete job for this data like a trigger would, so nothing gets built twice
+        # Bulk lane whatever it costs, nobody is waiting on it yet
+        repid, created = enqueuejob(store_id, ver, lane='bulk', cost=pricejob(store_id, None, data)[0])
+        if repid is None:
+            logging.info("Report queue is busy, prewarming stops for this round.")
+            break
+        if created:
+            jobready.release()
+            queued += 1
+    if queued:
+        with metrics_lock:
+            prewarmed += queued
+        logging.info("Queued %d reports of hot stores ahead of their triggers.", queued)
+    return queued
+
+def prewarmer(): # Runs prewarmpass every PREWARM_EVERY seconds for the life of the process
+    rnd = random.Random()
+    time.sleep(rnd.uniform(0, PREWARM_EVERY)) # Processes started together don't run their rounds in lockstep
+    while PREWARM_STORES:
+        started = time.monotonic()
+        try:
+            prewarmpass(rnd)
+        except Exception as e:
+            logging.error("Report prewarm round failed: %s", e)
+        time.sleep(max(0.0, PREWARM_EVERY - (time.monotonic() - started)))
+
+@app.cli.command('sweep-reports') # flask --app new_flask_app sweep-reports [--vacuum]
+@click.option('--vacuum', is_flag=True, help="Run a full VACUUM afterwards, which also switches older databases to incremental auto_vacuum.")
+def sweep_reports_command(vacuum):
+    click.echo(f"Purged {sweepreports()} rows.")
+    if vacuum:
+        with dbconn() as conn:
+            conn.execute("VACUUM")
+        click.echo("Vacuumed.")
+
+@app.before_request
+def startworkers(): # Starts the bounded pool of report workers and the heartbeat, once per process
+    if len(workers) > WORKERS:
+        return
+    with reports_lock:
+        while len(workers) < WORKERS:
+            thread = threading.Thread(target=worker, name=f"report-worker-{len(workers)}", daemon=True)
+            thread.start()
+            workers.append(thread)
+        if len(workers) == WORKERS:
+            for target in (heartbeat, sweeper, prewarmer):
+                thread = threading.Thread(target=target, name=f"report-{target.__name__}", daemon=True)
+                thread.start()
+                workers.append(thread)
+
+@app.route('/trigger_report', methods=['GET', 'POST']) # /trigger_report api route, GET for one store (or all), POST for a list of stores
 def trigger_report():
-    store_id = request.args.get('store_id') # get the store_id
-    if not store_id:
-        msg = "Forgot to include 'store_id' in your request?"
-        logging.error(msg) # call the logging function
-        return jsonify({"error": msg}), 400 # Conversion to json for the message transfer over http 
-    # 400 is bad request
+    stores = None
+    if request.method == 'POST': # Batch, {"store_ids": [...]} -> one job, one report with a row per store
+        body = request.get_json(silent=True) or {}
+        stores = body.get('store_ids')
+        if not isinstance(stores, list) or not stores or not all(isinstance(x, str) and x for x in stores):
+            msg = "POST a JSON body like {\"store_ids\": [\"<Store_ID>\", ...]}."
+            logging.error(msg)
+            return jsonify({"error": msg}), 400
+        stores = sorted(set(stores))
+        if len(stores) > BATCH_MAX:
+            msg = f"A batch can list at most {BATCH_MAX} stores, got {len(stores)}."
+            logging.error(msg)
+            return jsonify({"error": msg}), 400
+        store_id = batchkey(stores)
+    else:
+        store_id = request.args.get('store_id') # get the store_id
+        if not store_id: # No store_id means the whole fleet
+            store_id = ALLSTORES
+        elif PREWARM_STORES:
+            noteheat(store_id) # Single stores only, fleet and batch reports are too big to rebuild on a hunch
 
-    try:
-        repid = str(uuid.uuid4()) # assigning unique id for every report
-    except Exception as e:
-        msg = f"Could not generate a report ID: {e}"  # Generation of ID failed
-        logging.error(msg) # Important message to log
-        return jsonify({"error": msg}), 500 # Not soo unexpected(edgecase handled?) condition, not able to process. Any edge case failure will give this
+    data = dataver(store_id, stores)
+    ver = verkey(data) # Same store against the same data = same report
+    profiled = request.args.get('profile') == '1' # Run this one under cProfile, summary goes on its job
+
+    with reports_lock: # Lock for avoiding race conditions
+        repid = cachedrep((store_id, ver)) if ver and not profiled else None
+    if repid: # No new status rows since this one was built, hand it out as is
+        logging.info("Report %s for store '%s' served from the report cache.", repid, store_id)
+        return jsonify({"repid": repid})
 
+    cost, lane = pricejob(store_id, stores, data)
+    client = request.headers.get('X-Client-Id') or request.remote_addr # Who the per-client limits count against
     try:
-        with reports_lock: # Lock for avoiding race conditions
-            reports[repid] = {'store_id': store_id, 'state': 'Pending', 'repdata': None} # Dictionary with empty data field
+        repid, created = enqueuejob(store_id, ver, stores, profiled, lane, cost, client)
     except Exception as e:
-        msg = f"Could not save report metadata for report {repid}: {e}"
+        msg = f"Could not save report metadata for store {store_id}: {e}"
         logging.error(msg) # Imp logging
         return jsonify({"error": msg}), 500 # Not soo unexpected(edgecase handled?) condition
+    if repid is None:
+        with metrics_lock:
+            rejected[created] += 1
+        if created == 'client':
+            msg = f"You already have {CLIENT_JOBS} reports ({CLIENT_BULK_JOBS} fleet/batch sized) queued or running. Try again once one is done."
+            logging.error("Client %s is at its report limit, rejecting %s trigger for store '%s'.", client, lane, store_id)
+            return jsonify({"error": msg}), 429, {"Retry-After": str(RETRY_AFTER)} # Too many requests, from this client
+        msg = "Too many reports are queued right now. Try again in a bit."
+        logging.error("Report queue is full for %s reports, rejecting trigger for store '%s'.", lane, store_id)
+        return jsonify({"error": msg}), 503, {"Retry-After": str(RETRY_AFTER)} # Service unavailable, for now
+    if not created: # Already Pending/Running or freshly Complete, maybe from another process, attach to it
+        logging.info("Report %s for store '%s' already exists for this data, attaching.", repid, store_id)
+        return jsonify({"repid": repid})
+    jobready.release() # Wake one of our workers
+
+    logging.info("Report %s triggered successfully for store '%s' (%s, cost %s).", repid, store_id, lane, cost) # Trigger process successful
+    return jsonify({"repid": repid}) # Return the id over http
+
+@app.route('/ingest', methods=['POST']) # Body is the CSV itself, ?table=store_status|timezones|business_hours&rebuild_indexes=1, appends only
+def ingest_route():
+    table = request.args.get('table', 'store_status')
+    if table not in INGEST_TABLES:
+        msg = f"Can't ingest into '{table}', pick one of {', '.join(sorted(INGEST_TABLES))}."
+        logging.error(msg)
+        return jsonify({"error": msg}), 400
+    mode = request.args.get('mode', 'append')
+    if mode != 'append': # Emptying a table is for the ingest CLI command (--replace), not for anyone who can reach the port
+        msg = f"Ingest mode '{mode}' isn't available over HTTP, only append; use `flask ingest --replace` to replace a table."
+        logging.error(msg)
+        return jsonify({"error": msg}), 400
+    rebuild = request.args.get('rebuild_indexes') == '1'
 
     try:
-        thread = threading.Thread(target=buildrep, args=(repid, store_id)) # Building report, assign it to a thread
-        thread.start() # Start building the report 
+        lines = io.TextIOWrapper(request.stream, encoding='utf-8', newline='') # Parsed as it comes in, never held whole
+        count, seconds = ingest(table, lines, False, rebuild)
+    except ValueError as e:
+        logging.error("Rejected ingest into %s: %s", table, e)
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        msg = f"Failed to start report processing for report {repid}: {e}" 
-        logging.error(msg) # Log the failure of report processing
-        return jsonify({"error": msg}), 500 # Not soo unexpected(edgecase handled?) condition 
-
-    logging.info("Report %s triggered successfully for store '%s'.", repid, store_id) # Trigger process successful
-    return jsonify({"repid": repid}) # Return the id over http
+        msg = f"Ingest into {table} failed: {e}"
+        logging.error(msg)
+        return jsonify({"error": msg}), 500
+    return jsonify({"table": table, "rows": count, "seconds": round(seconds, 3), "rows_per_sec": round(count / seconds) if seconds else count})
 
 @app.route('/get_report', methods=['GET']) # API route /get_report that allows GET report
 def get_report():
@@ -268,25 +1778,190 @@ def get_report():
         logging.error(msg) # Log this error
         return jsonify({"error": msg}), 400 # Bad request
 
-    repdata = fetchrep(repid)
-    if repdata is None:
+    takesgzip = REPORT_GZIP and 'gzip' in request.accept_encodings
+    job = jobstate(repid) # Any process's job, reports from before report_jobs have none and go straight to storage
+    try:
+        wait = min(float(request.args.get('wait', 0)), JOB_WAIT_MAX) # Seconds to hold the request for a report that isn't done
+    except ValueError:
+        msg = "wait has to be a number of seconds."
+        logging.error(msg)
+        return jsonify({"error": msg}), 400
+    deadline = time.monotonic() + wait
+    while job is not None and job[0] in ('Pending', 'Running') and time.monotonic() < deadline:
+        job = waitjob(repid, job[0], deadline - time.monotonic())
+    if job is not None and job[0] in ('Pending', 'Running'):
+        logging.debug("Report %s is still in state '%s'.", repid, job[0]) # Polls, not worth an INFO line each
+        return jsonify({"repid": repid, "state": job[0]}), 202, {"Retry-After": str(RETRY_AFTER)} # Accepted, not done yet
+    if job is not None and job[0] == 'Error':
+        msg = "There was an error generating your report. Please try again later."
+        logging.error("Report %s ended in an error state: %s", repid, job[1])
+        return jsonify({"error": msg, "state": "Error"}), 500
+
+    stored = openrep(repid)
+    if stored is None:
         msg = f"We couldn't find a stored report with ID '{repid}'."
         logging.error(msg)
         return jsonify({"error": msg}), 404
 
+    rowid, path, size, encoding = stored
+    if path and (encoding is None or takesgzip): # A report never changes once stored, its ID is its ETag
+        etag = f"{repid}-gz" if encoding else repid
+    elif path:
+        etag = repid
+    else:
+        etag = f"{repid}-gz" if takesgzip else repid
+    if request.if_none_match.contains_weak(etag): # Only now that we know it's stored, Pending/Error/missing reports never get a 304
+        response = make_response('', 304)
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = f"private, max-age={REPORT_MAX_AGE}, immutable"
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
+
     try:
-        response = make_response(repdata)
-        response.headers["Content-Type"] = "text/csv"
+        if path and (encoding is None or takesgzip): # The file as it is on disk, sendfile and Range requests through send_file
+            response = send_file(
+                path, mimetype="text/csv", as_attachment=True, download_name="report.csv",
+                conditional=True, etag=etag, max_age=REPORT_MAX_AGE
+            )
+            if encoding:
+                response.headers["Content-Encoding"] = encoding
+            logging.info("Sending report file %s for report %s.", path, repid)
+        elif path: # gzipped on disk, client wants it plain
+            response = Response(stream_with_context(streamfile(path)), mimetype="text/csv")
+            logging.info("Streaming decompressed report file %s for report %s.", path, repid)
+        else: # Report from before the files, still in repdata
+            response = Response(stream_with_context(streamrep(rowid, takesgzip)), mimetype="text/csv") # Never more than a chunk in memory
+            if takesgzip:
+                response.headers["Content-Encoding"] = "gzip"
+            else:
+                response.headers["Content-Length"] = str(size)
+            logging.info("Streaming stored CSV for report %s.", repid)
         response.headers["Content-Disposition"] = 'attachment; filename="report.csv"'
-        logging.info("Returning stored CSV for report %s.", repid)
+        response.headers["Cache-Control"] = f"private, max-age={REPORT_MAX_AGE}, immutable"
+        response.headers["Vary"] = "Accept-Encoding"
+        response.set_etag(etag)
         return response
     except Exception as e:
         msg = f"Failed to create CSV response for report {repid}: {e}"
         logging.error(msg)
         return jsonify({"error": msg}), 500
 
+@app.route('/report_profile', methods=['GET']) # cProfile summary of a report triggered with profile=1
+def report_profile():
+    repid = request.args.get('repid')
+    if not repid:
+        msg = "The ID of the report is missing from the request."
+        logging.error(msg)
+        return jsonify({"error": msg}), 400
+    try:
+        with dbconn() as conn:
+            row = conn.execute("SELECT state, profiled, profile FROM report_jobs WHERE report_id=?", (repid,)).fetchone()
+    except sqlite3.Error as e:
+        msg = f"Cannot look up report {repid}: {e}"
+        logging.error(msg)
+        return jsonify({"error": msg}), 500
+    if row is None or not row[1]:
+        msg = f"Report '{repid}' doesn't exist or wasn't triggered with profile=1."
+        logging.error(msg)
+        return jsonify({"error": msg}), 404
+    if row[2] is None:
+        return jsonify({"repid": repid, "state": row[0]}), 202, {"Retry-After": str(RETRY_AFTER)} # Not done yet
+    return Response(row[2], mimetype='text/plain')
+
+def promlines(): # Everything /metrics exposes, in Prometheus text format
+    lines = [
+        "# HELP store_report_stage_seconds Time spent in each stage of building reports.",
+        "# TYPE store_report_stage_seconds histogram",
+    ]
+    with metrics_lock: # Copies, the formatting happens outside the lock
+        snapshot = {stage: (list(h['buckets']), h['sum'], h['count']) for stage, h in histograms.items()}
+        done = dict(finished)
+        running = busy
+        runningbulk = bulkbusy
+        turnedaway = dict(rejected)
+        queued = prewarmed
+    for stage, (buckets, total, count) in snapshot.items():
+        cumulative = 0
+        for le, n in zip(METRIC_BUCKETS, buckets):
+            cumulative += n
+            lines.append(f'store_report_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+        lines.append(f'store_report_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+        lines.append(f'store_report_stage_seconds_sum{{stage="{stage}"}} {total}')
+        lines.append(f'store_report_stage_seconds_count{{stage="{stage}"}} {count}')
+    lines += ["# HELP store_reports_finished_total Reports this process finished, by outcome.", "# TYPE store_reports_finished_total counter"]
+    lines += [f'store_reports_finished_total{{state="{state}"}} {n}' for state, n in done.items()]
+    lines += ["# HELP store_report_workers_busy Reports this process is building right now.", "# TYPE store_report_workers_busy gauge", f"store_report_workers_busy {running}"]
+    lines += ["# HELP store_report_bulk_workers_busy Bulk reports this process is building right now.", "# TYPE store_report_bulk_workers_busy gauge", f"store_report_bulk_workers_busy {runningbulk}"]
+    lines += ["# HELP store_report_triggers_rejected_total Triggers turned away, full queue (503) or client over its limit (429).", "# TYPE store_report_triggers_rejected_total counter"]
+    lines += [f'store_report_triggers_rejected_total{{reason="{reason}"}} {n}' for reason, n in turnedaway.items()]
+    lines += ["# HELP store_reports_prewarmed_total Reports of hot stores this process queued ahead of their triggers.", "# TYPE store_reports_prewarmed_total counter", f"store_reports_prewarmed_total {queued}"]
+    with dbconn() as conn: # Shared by every process, so from the table rather than from memory
+        states = {(state, lane): n for state, lane, n in conn.execute(
+            "SELECT state, lane, COUNT(*) FROM report_jobs WHERE state IN ('Pending', 'Running') GROUP BY state, lane"
+        )}
+    lines += ["# HELP store_report_jobs Report jobs waiting (Pending) and in flight (Running) across all processes, by lane.", "# TYPE store_report_jobs gauge"]
+    lines += [f'store_report_jobs{{state="{state}",lane="{lane}"}} {states.get((state, lane), 0)}' for state in ('Pending', 'Running') for lane in LANES]
+    lines += [
+        "# HELP store_report_queue_depth_limit Pending jobs allowed before triggers get a 503.", "# TYPE store_report_queue_depth_limit gauge", f"store_report_queue_depth_limit {QUEUE_DEPTH}",
+        "# HELP store_report_cache_entries Finished reports remembered in this process.", "# TYPE store_report_cache_entries gauge", f"store_report_cache_entries {len(repcache)}",
+        "# HELP store_event_index_stores Stores held in this process's event index.", "# TYPE store_event_index_stores gauge", f"store_event_index_stores {len(eventindex)}",
+        "# HELP store_event_index_events Events held in this process's event index.", "# TYPE store_event_index_events gauge", f"store_event_index_events {eventindex_size}",
+    ]
+    return lines
+
+@app.route('/metrics', methods=['GET']) # Prometheus scrape target, per process
+def metrics():
+    try:
+        body = "\n".join(promlines()) + "\n"
+    except Exception as e:
+        msg = f"Couldn't collect metrics: {e}"
+        logging.error(msg)
+        return jsonify({"error": msg}), 500
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+@app.route('/report_events', methods=['GET']) # Server-sent events, one "state" event per state change of a report
+def report_events():
+    repid = request.args.get('repid')
+    if not repid:
+        msg = "The ID of the report is missing from the request."
+        logging.error(msg)
+        return jsonify({"error": msg}), 400
+
+    job = jobstate(repid)
+    if job is None and openrep(repid) is not None: # Stored before report_jobs existed
+        job = ('Complete', None)
+    if job is None:
+        msg = f"We couldn't find report with ID '{repid}'."
+        logging.error(msg)
+        return jsonify({"error": msg}), 404
+
+    def events():
+        opened = time.monotonic()
+        current, state = job, None
+        while current is not None:
+            if current[0] != state:
+                state = current[0]
+                data = {"repid": repid, "state": state}
+                if state == 'Error':
+                    data["error"] = current[1]
+                yield f"event: state\ndata: {json.dumps(data)}\n\n"
+                if state in ('Complete', 'Error'):
+                    return
+            else:
+                yield ": keepalive\n\n" # Keeps proxies from timing out a quiet stream
+            if time.monotonic() - opened > SSE_MAX:
+                return # The client reconnects if it still cares
+            current = waitjob(repid, state, SSE_KEEPALIVE)
+
+    logging.info("Streaming state changes of report %s.", repid)
+    return Response(
+        stream_with_context(events()), mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"} # No buffering in nginx either
+    )
+
 if __name__ == '__main__':
     try:
+        loadtimezones() # Preload, the first report shouldn't pay for it
         logging.info(" Server running on 192.168.0.107:8001")
         app.run(host='192.168.0.107', port=8001, debug=True) # apply it on the ip, port 
     except Exception as e:
@@ -7,6 +7,9 @@ import io
 import sqlite3
 import datetime
 import logging
+import os
+import zlib
+import collections
 
 app = Flask(__name__)
 
@@ -17,8 +20,29 @@ logging.basicConfig( # Basic logging structure for all the mishaps that may occu
 )
 
 # In-memory store for reports.
-reports = {} # Dictionary for reports
+reports = collections.OrderedDict() # Dictionary for reports, least recently used first
 reports_lock = threading.Lock() # Thread lock for handling unpredictiveness (Possibility of Edge Case?)
+REPORT_ENTRIES = int(os.environ.get('REPORT_MEMORY_ENTRIES', 1000)) # Finished reports kept, least recently used go first past this
+REPORT_MEMORY_BYTES = int(os.environ.get('REPORT_MEMORY_BYTES', 64 * 1024 * 1024)) # Compressed CSV bytes kept, same deal
+REPORT_TTL = int(os.environ.get('REPORT_RETENTION', 86400)) # Seconds a finished report is kept at all
+reports_bytes = 0 # Compressed bytes held in reports, guarded by reports_lock
+
+def trimreports(): # Drops expired reports, then least recently used ones while over a cap, caller holds reports_lock
+    # Pending/Running entries hold no data and are never dropped
+    global reports_bytes
+    now = time.monotonic()
+    for repid, report in list(reports.items()):
+        if 'finished' in report and now - report['finished'] > REPORT_TTL:
+            reports_bytes -= len(report['repdata'] or b'')
+            del reports[repid]
+    finished = [repid for repid, report in reports.items() if 'finished' in report] # Oldest use first
+    kept = len(finished)
+    for repid in finished:
+        if kept <= REPORT_ENTRIES and reports_bytes <= REPORT_MEMORY_BYTES:
+            break
+        reports_bytes -= len(reports[repid]['repdata'] or b'')
+        del reports[repid]
+        kept -= 1
 
 def dbconnect(): # Connects to sql database
     try:
@@ -155,6 +179,7 @@ def gencsv(store_id):
     return output.getvalue()  # Output the csv
 
 def buildrep(repid, store_id): # to build the csv
+    global reports_bytes
     try:
         with reports_lock: # Lock cpu for one process (edge case?)
             reports[repid]['state'] = 'Running'
@@ -162,9 +187,13 @@ def buildrep(repid, store_id): # to build the csv
         repdata = gencsv(store_id) # call function
         if repdata is None: # If it returns None
             raise Exception("CSV generation failed (returned None).")
+        repdata = zlib.compress(repdata.encode('utf-8')) # CSVs shrink a lot, decompressed when served
         with reports_lock: # lock report to ensure only one process access the db
             reports[repid]['repdata'] = repdata # Dictionary with key report report ID and object report data = report data
             reports[repid]['state'] = 'Complete' # Mark it as complete if done
+            reports[repid]['finished'] = time.monotonic()
+            reports_bytes += len(repdata)
+            trimreports()
         logging.info("Report %s for store '%s' completed successfully.", repid, store_id) # Log it as success
     except Exception as e:
         error_msg = f"Error processing report {repid} for store '{store_id}': {e}" # Processing error
@@ -172,6 +201,8 @@ def buildrep(repid, store_id): # to build the csv
         with reports_lock:
             reports[repid]['state'] = 'Error'
             reports[repid]['repdata'] = None # Error gives out None datatype
+            reports[repid]['finished'] = time.monotonic()
+            trimreports()
 
 @app.route('/trigger_report', methods=['GET']) # /trigger_report api route , allows GET method
 def trigger_report():
@@ -218,14 +249,17 @@ def get_report():
 
     try:
         with reports_lock: # No race conditions
+            trimreports() # Expired ones go even if nothing new finished
             report = reports.get(repid) # get the report ID
+            if report is not None:
+                reports.move_to_end(repid) # LRU
     except Exception as e:
         msg = f"Cannot accessing report {repid}: {e}" # Accessing error
         logging.error(msg) # Log this too
         return jsonify({"error": msg}), 500 # Not soo unexpected(edgecase handled?) error
 
     if report is None: # If it couldnt find one
-        msg = f"We couldn't find report with ID '{repid}'."
+        msg = f"We couldn't find report with ID '{repid}', it may have expired."
         logging.error(msg) # Log it in
         return jsonify({"error": msg}), 404 # There exists no resource that was requested
 
@@ -239,7 +273,7 @@ def get_report():
         return jsonify({"error": msg}), 500 # UNexpected condition handled
     elif report['state'] == 'Complete': # if completed , we need to download, filegen
         try:
-            response = make_response(report['repdata'])
+            response = make_response(zlib.decompress(report['repdata']).decode('utf-8'))
             response.headers["Content-Type"] = "text/csv" # CSV is the document type
             response.headers["Content-Disposition"] = 'attachment; filename="report.csv"' # name the csv file
             logging.info("Completed a CSV for report %s.", repid) # Log this in